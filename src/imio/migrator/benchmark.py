@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------------------
+# GNU General Public License (GPL)
+# ------------------------------------------------------------------------------
+"""
+Benchmark of the Migrator long operations on synthetic sites, built on the MIGRATOR_TESTING_PROFILE_FUNCTIONAL
+layer. Each operation is run on a freshly generated site and its objects rate, memory and transaction size
+are written as json, to be compared between versions. Used with the zopepy interpreter of dev.cfg (with test extras):
+
+    bin/zopepy -m imio.migrator.benchmark --objects 5000 --orphans 0.05 --output bench.json
+    bin/zopepy -m imio.migrator.benchmark --compare old.json new.json
+"""
+from Acquisition import aq_base
+from imio.migrator.migrator import Migrator
+from imio.migrator.utils import resource_usage
+
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import transaction
+
+
+logger = logging.getLogger('imio.migrator')
+DEFAULT_TYPES = {'Document': 7, 'Folder': 2, 'News Item': 1}
+OPERATIONS = ('reindexIndexes', 'reindexIndexesFor', 'clean_orphan_brains', 'refreshDatabase')
+WORDS = ('migration', 'catalog', 'index', 'plone', 'zope', 'storage', 'commune', 'budget', 'decision', 'meeting')
+
+
+class BenchmarkMigrator(Migrator):
+    """Migrator used to run the benchmarked operations."""
+
+    def run(self):
+        pass
+
+
+def setup_layer(layer, done):
+    """Set up p_layer after its bases, like the test runner. Set up layers are appended to p_done."""
+    for base in layer.__bases__:
+        setup_layer(base, done)
+    if layer not in done:
+        layer.setUp()
+        done.append(layer)
+
+
+def test_setup(layers):
+    """Call testSetUp on the set up p_layers."""
+    for layer in layers:
+        layer.testSetUp()
+
+
+def test_teardown(layers):
+    """Call testTearDown on the set up p_layers, in reverse order."""
+    for layer in reversed(layers):
+        layer.testTearDown()
+
+
+def teardown_layers(layers):
+    """Tear down the set up p_layers, in reverse order."""
+    for layer in reversed(layers):
+        try:
+            layer.tearDown()
+        except NotImplementedError:
+            pass
+
+
+def weighted_choice(rnd, weights):
+    """Choose a key of p_weights dict following its weight value."""
+    total = sum(weights.values())
+    point = rnd.uniform(0, total)
+    for key in sorted(weights):
+        point -= weights[key]
+        if point <= 0:
+            return key
+    return key
+
+
+def generate_site(portal, objects=1000, orphans=0.0, types=DEFAULT_TYPES, seed=0, batch_size=500):
+    """Create p_objects objects in p_portal, with a p_types mix (portal_type as key and weight as value).
+       Objects are put in random created folderish objects. A p_orphans ratio of the not folderish objects
+       is then deleted without uncataloging them. The same p_seed gives the same site.
+       Returns the number of orphan brains."""
+    from plone import api
+
+    rnd = random.Random(seed)
+    containers = [portal]
+    leaves = []
+    for nb in range(objects):
+        container = rnd.choice(containers)
+        obj = api.content.create(container=container, type=weighted_choice(rnd, types), id='obj-{}'.format(nb),
+                                 title=' '.join([rnd.choice(WORDS) for word in range(4)]),
+                                 safe_id=True)
+        if getattr(aq_base(obj), 'isPrincipiaFolderish', False):
+            containers.append(obj)
+        else:
+            leaves.append(obj)
+        if (nb + 1) % batch_size == 0:
+            transaction.commit()
+            portal._p_jar.cacheMinimize()
+    orphaned = rnd.sample(leaves, min(len(leaves), int(objects * orphans)))
+    for obj in orphaned:
+        obj.aq_parent._delObject(obj.getId(), suppress_events=True)
+    transaction.commit()
+    return len(orphaned)
+
+
+def run_operation(migrator, operation, types=DEFAULT_TYPES, batch_size=1000):
+    """Run the benchmarked p_operation with p_migrator. Returns the number of handled objects."""
+    catalog = migrator.catalog
+    if operation == 'reindexIndexes':
+        migrator.reindexIndexes(idxs=['Title', 'sortable_title'], update_metadata=True, chunk_size=batch_size)
+    elif operation == 'reindexIndexesFor':
+        migrator.reindexIndexesFor(idxs=['SearchableText'], batch_size=batch_size, portal_type=sorted(types))
+    elif operation == 'clean_orphan_brains':
+        migrator.clean_orphan_brains({'portal_type': sorted(types)}, batch_size=batch_size)
+    elif operation == 'refreshDatabase':
+        migrator.refreshDatabase(
+            catalogsToUpdate=[cat_id for cat_id in ('reference_catalog', 'uid_catalog')
+                              if cat_id in migrator.portal.objectIds()])
+        return len(catalog._catalog)
+    else:
+        raise ValueError("Unknown operation '{}'".format(operation))
+    return migrator.loop_stats.get(operation, {}).get('processed')
+
+
+def storage_size(portal):
+    """Get the size in bytes of the portal storage, or None if not available."""
+    storage = portal._p_jar.db().storage
+    try:
+        return storage.getSize()
+    except Exception:
+        return None
+
+
+def benchmark(operations=OPERATIONS, objects=1000, orphans=0.05, types=DEFAULT_TYPES, seed=0, batch_size=1000,
+              repeat=1):
+    """Run each of p_operations p_repeat times on a synthetic site (see generate_site) generated in a new
+       functional test storage. Returns the results dict."""
+    from imio.migrator.testing import MIGRATOR_TESTING_PROFILE_FUNCTIONAL
+    from plone.app.testing import login
+    from plone.app.testing import setRoles
+    from plone.app.testing import TEST_USER_ID
+    from plone.app.testing import TEST_USER_NAME
+    from zope.component.hooks import setSite
+
+    results = {'params': {'objects': objects, 'orphans': orphans, 'types': types, 'seed': seed,
+                          'batch_size': batch_size, 'repeat': repeat},
+               'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'python': platform.python_version(),
+               'version': package_version(),
+               'results': []}
+    layers = []
+    setup_layer(MIGRATOR_TESTING_PROFILE_FUNCTIONAL, layers)
+    try:
+        for operation in operations:
+            for run in range(repeat):
+                test_setup(layers)
+                try:
+                    portal = MIGRATOR_TESTING_PROFILE_FUNCTIONAL['portal']
+                    setSite(portal)
+                    setRoles(portal, TEST_USER_ID, ['Manager'])
+                    login(portal, TEST_USER_NAME)
+                    logger.info("Generating site for '{0}' run {1}".format(operation, run + 1))
+                    orphaned = generate_site(portal, objects=objects, orphans=orphans, types=types, seed=seed)
+                    migrator = BenchmarkMigrator(portal)
+                    migrator.report_file = ''
+                    size = storage_size(portal)
+                    start = resource_usage(portal._p_jar)
+                    handled = run_operation(migrator, operation, types=types, batch_size=batch_size)
+                    transaction.commit()
+                    end = resource_usage(portal._p_jar)
+                    result = {'operation': operation, 'run': run + 1, 'objects': handled, 'orphans': orphaned}
+                    for key in ('wall', 'cpu', 'loads', 'stores'):
+                        result[key] = round(end[key] - start[key], 3)
+                    result['objects_per_second'] = handled and round(handled / (result['wall'] or 1), 1)
+                    result['peak_rss'] = end['peak_rss']
+                    result['peak_rss_growth'] = round(end['peak_rss'] - start['peak_rss'], 3)
+                    end_size = storage_size(portal)
+                    result['storage_growth'] = size is not None and end_size is not None and end_size - size or None
+                    logger.info('Benchmark {0}'.format(result))
+                    results['results'].append(result)
+                finally:
+                    transaction.abort()
+                    setSite(None)
+                    test_teardown(layers)
+    finally:
+        teardown_layers(layers)
+    return results
+
+
+def package_version():
+    """Get the installed imio.migrator version."""
+    import pkg_resources
+    try:
+        return pkg_resources.get_distribution('imio.migrator').version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+def compare(old, new):
+    """Compare the p_old and p_new results dicts. Returns the list of (operation, old rate, new rate, ratio)
+       based on the best objects rate of each operation."""
+    def best_rates(results):
+        rates = {}
+        for result in results['results']:
+            rates[result['operation']] = max(rates.get(result['operation'], 0), result['objects_per_second'] or 0)
+        return rates
+
+    old_rates = best_rates(old)
+    new_rates = best_rates(new)
+    return [(operation, old_rates[operation], new_rates[operation],
+             old_rates[operation] and round(new_rates[operation] / old_rates[operation], 2) or None)
+            for operation in sorted(old_rates) if operation in new_rates]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the imio.migrator operations on synthetic sites.')
+    parser.add_argument('--objects', type=int, default=1000, help='number of created objects')
+    parser.add_argument('--orphans', type=float, default=0.05, help='ratio of orphan brains')
+    parser.add_argument('--types', default='', help='portal types mix, like "Document:7,Folder:2,News Item:1"')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--batch-size', type=int, default=1000, help='operations batch size')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each operation')
+    parser.add_argument('--operations', default=','.join(OPERATIONS), help='comma separated operations')
+    parser.add_argument('--output', default='', help='json output file (stdout if empty)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two json output files')
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+    if args.compare:
+        with open(args.compare[0]) as fh:
+            old = json.load(fh)
+        with open(args.compare[1]) as fh:
+            new = json.load(fh)
+        for operation, old_rate, new_rate, ratio in compare(old, new):
+            print('{0}: {1} -> {2} objects/s (x{3})'.format(operation, old_rate, new_rate, ratio))
+        return
+    types = DEFAULT_TYPES
+    if args.types:
+        types = dict([(name.strip(), float(weight)) for name, weight in
+                      [part.rsplit(':', 1) for part in args.types.split(',')]])
+    results = benchmark(operations=[op.strip() for op in args.operations.split(',') if op.strip()],
+                        objects=args.objects, orphans=args.orphans, types=types, seed=args.seed,
+                        batch_size=args.batch_size, repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
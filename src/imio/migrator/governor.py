@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------------------
+# GNU General Public License (GPL)
+# ------------------------------------------------------------------------------
+"""
+Memory governor used by the Migrator long loops to keep the process resident memory under a budget.
+"""
+from imio.pyutils.system import process_memory
+
+import gc
+import logging
+import time
+
+
+logger = logging.getLogger('imio.migrator')
+
+
+class MemoryGovernor(object):
+    """Decide when a long loop must commit, following its batch size and the used memory.
+
+    The loop calls step after each handled item and commits (with Migrator.commit_and_minimize) when it returns
+    True. If a memory budget (in Mb) is given:
+
+    * the used memory is checked at most every p_check_interval seconds. When it exceeds the budget, the garbage
+      collector is run and an intermediate commit is asked, even if the loop has no batch size;
+    * the batch size is adapted at each commit: halved when the used memory is near the budget, increased by a
+      quarter when it's well under it and the processing rate doesn't drop.
+    """
+
+    def __init__(self, name, batch_size=0, budget=0, min_batch_size=50, max_batch_size=20000,
+                 check_interval=1.0):
+        self.name = name
+        self.batch_size = batch_size
+        self.budget = budget
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max(max_batch_size, batch_size)
+        self.check_interval = check_interval
+        # number of items since the last commit
+        self.count = 0
+        self.commits = 0
+        self.last_rate = 0
+        self.chunk_start = self.last_check = time.time()
+
+    @property
+    def active(self):
+        """Intermediate commits can be asked."""
+        return bool(self.batch_size or self.budget)
+
+    def step(self):
+        """Count a handled item. Returns True if the loop must commit now."""
+        self.count += 1
+        if self.batch_size and self.count >= self.batch_size:
+            self.adapt()
+            return self.committing()
+        if not self.budget or self.count < self.min_batch_size:
+            return False
+        now = time.time()
+        if now - self.last_check < self.check_interval:
+            return False
+        self.last_check = now
+        used = process_memory()
+        if used <= self.budget:
+            return False
+        logger.warning('{0}: used memory {1} Mb is higher than the {2} Mb budget after {3} items, committing'
+                       .format(self.name, used, self.budget, self.count))
+        gc.collect()
+        self.resize(max(self.min_batch_size, (self.batch_size or self.count) // 2))
+        return self.committing()
+
+    def adapt(self):
+        """Adapt the batch size following the used memory and the processing rate of the last chunk."""
+        if not self.budget:
+            return
+        rate = self.count / max(time.time() - self.chunk_start, 0.001)
+        used = process_memory()
+        if used > self.budget * 0.85:
+            gc.collect()
+            self.resize(max(self.min_batch_size, self.batch_size // 2))
+        elif used < self.budget * 0.6 and rate >= self.last_rate * 0.9:
+            self.resize(min(self.max_batch_size, int(self.batch_size * 1.25)))
+        self.last_rate = rate
+
+    def resize(self, batch_size):
+        """Set the batch size to p_batch_size."""
+        if batch_size != self.batch_size:
+            logger.info('{0}: batch size changed from {1} to {2}'.format(self.name, self.batch_size, batch_size))
+            self.batch_size = batch_size
+
+    def committing(self):
+        """Reset the chunk counters before the loop commits. Returns True."""
+        self.commits += 1
+        self.count = 0
+        self.chunk_start = self.last_check = time.time()
+        return True
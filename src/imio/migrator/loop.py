@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------------------
+# GNU General Public License (GPL)
+# ------------------------------------------------------------------------------
+"""
+Batched loop used by the Migrator long loops: batching (imio.helpers.batching), progress reporting and intermediate
+commits following a MemoryGovernor.
+"""
+from imio.helpers.batching import batch_delete_files
+from imio.helpers.batching import batch_get_keys
+from imio.helpers.batching import batch_globally_finished
+from imio.helpers.batching import batch_handle_key
+from imio.helpers.batching import batch_loop_else
+from imio.helpers.batching import batch_skip_key
+from imio.helpers.batching import can_delete_batch_files
+
+import logging
+
+
+logger = logging.getLogger('imio.migrator')
+
+
+class BatchLoop(object):
+    """Loop on p_iterable, yielding the items to handle. Used like this:
+
+        loop = migrator.batch_loop('name', iterable, total, pklfile=pklfile, batch_size=batch_size)
+        for item in loop:
+            ...
+        return loop.finished
+
+    The loop body must not break, the loop end would not be done. Around the body, the loop:
+
+    * skips the items already done by a previous batching run (only if p_pklfile is given), the batching key of an
+      item being p_key(item) or the item itself;
+    * commits when the governor asks it, and at the end if intermediate commits were done or p_batch_size is set.
+      If p_redo is given, a ConflictError on commit does again the chunk, calling p_redo on each of its items.
+      p_before_commit is called before each commit;
+    * stops after a commit if the used memory (in Mb) is still higher than p_max_mem. The loop can then be
+      continued later with batching. As memory is only checked after an intermediate commit, p_max_mem needs
+      p_batch_size or a governor memory budget, a ValueError is raised otherwise;
+    * updates the migrator loop_stats[p_name] dict (processed, conflicts, stopped and finished).
+
+    If p_estimated, p_total is only an estimate used by the progress: the batching loop length is the count of
+    handled keys when the iterable is exhausted.
+
+    finished is then True if the loop is globally finished (see imio.helpers batching), else False.
+    """
+
+    def __init__(self, migrator, name, iterable, total=None, pklfile=None, batch_size=0, key=None, redo=None,
+                 before_commit=None, max_mem=0, estimated=False):
+        self.migrator = migrator
+        self.name = name
+        self.estimated = estimated
+        self.key = key
+        self.redo = redo
+        self.before_commit = before_commit
+        self.max_mem = max_mem
+        self.batch_size = batch_size
+        if pklfile:
+            self.batch_keys, self.batch_config = batch_get_keys(pklfile, loop_length=not estimated and total or 0,
+                                                                log=True)
+        else:
+            self.batch_keys, self.batch_config = None, {'bn': 0, 'fr': False, 'll': total}
+        self.progress = migrator.progress(name, iterable, total)
+        self.governor = migrator.governor(name, batch_size)
+        if max_mem and not self.governor.active:
+            raise ValueError('{0}: max_mem is only checked after an intermediate commit, a batch size or a memory '
+                             'budget (FUNC_MEM_BUDGET) is needed'.format(name))
+        self.stats = migrator.loop_stats[name] = {'processed': 0, 'conflicts': 0, 'stopped': False,
+                                                  'finished': None}
+        self.chunk = []
+        self.current_key = None
+        self.stopped = False
+        self.finished = None
+
+    def __iter__(self):
+        for item in self.progress:
+            key = item if self.key is None else self.key(item)
+            if batch_skip_key(key, self.batch_keys, self.batch_config):
+                self.progress.skip()
+                continue
+            self.current_key = key
+            yield item
+            if self.redo is not None and self.governor.active:
+                self.chunk.append(item)
+            if batch_handle_key(key, self.batch_keys, self.batch_config):
+                self.set_loop_length(exhausted=False)
+                break
+            if self.governor.step():
+                self.commit()
+                if self.max_mem and self.memory_exceeded():
+                    self.stopped = True
+                    break
+        else:
+            self.set_loop_length(exhausted=True)
+            batch_loop_else(self.batch_keys, self.batch_config)
+        self.end()
+
+    def set_loop_length(self, exhausted):
+        """If the total is estimated, set the batching loop length from the handled keys: their count if the
+           iterable is p_exhausted, else more so that a first run is not globally finished."""
+        if self.estimated and self.batch_keys is not None:
+            self.batch_config['ll'] = len(self.batch_keys) + (not exhausted and 1 or 0)
+
+    def memory_exceeded(self):
+        """Check if the used memory is higher than max_mem."""
+        if self.migrator.log_mem('{0} {1}'.format(self.name, self.progress.processed)) <= self.max_mem:
+            return False
+        logger.warning('{0} stopped after {1} objects: used memory is higher than {2} Mb'.format(
+            self.name, self.progress.processed, self.max_mem))
+        return True
+
+    def commit(self):
+        """Commit the handled items, doing the chunk again on conflict if redo is given."""
+        if self.before_commit is not None:
+            self.before_commit()
+        chunk, self.chunk = self.chunk, []
+
+        def redo():
+            for item in chunk:
+                self.redo(item)
+
+        self.stats['conflicts'] += self.migrator.commit_and_minimize(redo=self.redo is not None and redo or None)
+
+    def end(self):
+        """Do the last commit, finish the progress and batching, and update the stats."""
+        if self.stopped:
+            # keep the treated keys so the loop can be continued
+            batch_loop_else(self.batch_keys, self.batch_config)
+            self.finished = False
+        else:
+            if self.batch_size or self.governor.commits:
+                self.commit()
+            if can_delete_batch_files(self.batch_keys, self.batch_config):
+                batch_delete_files(self.batch_keys, self.batch_config, log=True)
+                self.finished = True
+            else:
+                self.finished = batch_globally_finished(self.batch_keys, self.batch_config)
+        self.progress.finish()
+        self.stats.update({'processed': self.progress.processed, 'stopped': self.stopped, 'finished': self.finished})
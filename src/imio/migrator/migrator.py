@@ -5,35 +5,128 @@
 """
 This module, borrowed from Products.PloneMeeting, defines helper methods to ease migration process.
 """
-from imio.helpers.batching import batch_delete_files
-from imio.helpers.batching import batch_get_keys
-from imio.helpers.batching import batch_globally_finished
-from imio.helpers.batching import batch_handle_key
+from Acquisition import aq_base
+from BTrees.IIBTree import intersection
+from BTrees.IIBTree import IITreeSet
+from BTrees.IIBTree import multiunion
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree
 from imio.helpers.batching import batch_hashed_filename
-from imio.helpers.batching import batch_loop_else
-from imio.helpers.batching import batch_skip_key
-from imio.helpers.batching import can_delete_batch_files
 from imio.helpers.catalog import removeColumns
 from imio.helpers.catalog import removeIndexes
+from imio.helpers.catalog import ZCTextIndexInfo
 from imio.helpers.content import disable_link_integrity_checks
 from imio.helpers.content import restore_link_integrity_checks
+from imio.migrator.governor import MemoryGovernor
+from imio.migrator.loop import BatchLoop
+from imio.migrator.profiler import start_profiler
+from imio.migrator.profiler import stop_profiler
+from imio.migrator.progress import Progress
 from imio.migrator.utils import end_time
+from imio.migrator.utils import get_plone_sites
+from imio.migrator.utils import in_shard
+from imio.migrator.utils import iterate_keys
+from imio.migrator.utils import resource_usage
+from imio.migrator.workers import merge_reports
+from imio.migrator.workers import run_workers
 from imio.pyutils.system import memory
 from imio.pyutils.system import process_memory
+from Missing import MV
+from persistent.mapping import PersistentMapping
 from plone import api
+from plone.indexer.interfaces import IIndexableObject
 from plone.registry.interfaces import IRegistry
 from Products.CMFPlone.utils import base_hasattr
+from Products.CMFPlone.utils import safe_callable
+from Products.GenericSetup.events import BeforeProfileImportEvent
+from Products.GenericSetup.events import ProfileImportedEvent
 from Products.GenericSetup.upgrade import normalize_version
-from Products.ZCatalog.ProgressHandler import ZLogHandler
+from Products.GenericSetup.utils import _resolveDottedName
+from ZODB.POSException import ConflictError
+from zope.annotation.interfaces import IAnnotations
 from zope.component import getUtility
+from zope.component import queryMultiAdapter
+from zope.component.hooks import setSite
+from zope.event import notify
 
+import contextlib
+import functools
+import glob
+import hashlib
+import json
 import logging
 import os
 import time
+import transaction
 
 
+try:
+    from plone.app.discussion.conversation import ANNOTATION_KEY as DISCUSSION_ANNOTATION_KEY
+except ImportError:
+    DISCUSSION_ANNOTATION_KEY = None
+
 logger = logging.getLogger('imio.migrator')
 CURRENTLY_MIGRATING_REQ_VALUE = 'imio_migrator_currently_migrating'
+DEFERRED_REINDEXES_REQ_VALUE = 'imio_migrator_deferred_reindexes'
+PARTS_ANNOTATION_KEY = 'imio.migrator.parts'
+SCHEMA_CHANGES_REQ_VALUE = 'imio_migrator_schema_changes'
+# attribute stored on the catalog during a schema change records pass
+SCHEMA_CHANGE_ATTR = '_imio_migrator_schema_change'
+REPORT_FILENAME = 'imio.migrator.report_{}.json'
+# import step handler dotted name: resolvable, shared by the migrators of the process (handlers are code)
+HANDLERS_CACHE = {}
+# index types whose stored value can be compared with the new one
+DIFFABLE_INDEX_TYPES = ('FieldIndex', 'KeywordIndex', 'UUIDIndex')
+IMPORT_STEPS_ANNOTATION_KEY = 'imio.migrator.import_steps'
+# files and directories read by import steps, used to know if a step input has changed since its last run
+IMPORT_STEP_FILES = {
+    'actions': ('actions.xml', ),
+    'browserlayer': ('browserlayer.xml', ),
+    'catalog': ('catalog.xml', ),
+    'componentregistry': ('componentregistry.xml', ),
+    'content_type_registry': ('content_type_registry.xml', ),
+    'controlpanel': ('controlpanel.xml', ),
+    'cssregistry': ('cssregistry.xml', ),
+    'factorytool': ('factorytool.xml', ),
+    'jsregistry': ('jsregistry.xml', ),
+    'memberdata-properties': ('memberdata_properties.xml', ),
+    'placeful_workflow': ('placeful_workflow.xml', 'placeful_workflow'),
+    'plone.app.registry': ('registry.xml', 'registry'),
+    'portlets': ('portlets.xml', ),
+    'properties': ('properties.xml', ),
+    'propertiestool': ('propertiestool.xml', ),
+    'rolemap': ('rolemap.xml', ),
+    'sharing': ('sharing.xml', ),
+    'skins': ('skins.xml', ),
+    'toolset': ('toolset.xml', ),
+    'typeinfo': ('types.xml', 'types'),
+    'viewlets': ('viewlets.xml', ),
+    'workflow': ('workflows.xml', 'workflows'),
+}
+
+
+def report_dir():
+    """Get the directory where the json reports are written, following MIGRATOR_REPORT env variable
+       (a directory, or 1 for INSTANCE_HOME). Returns None if reports are disabled (default)."""
+    directory = os.getenv('MIGRATOR_REPORT', '')
+    if directory in ('', '0'):
+        return None
+    if directory == '1':
+        return os.getenv('INSTANCE_HOME', '.')
+    return directory
+
+
+def measured(kind):
+    """Decorator recording the resources usage of a Migrator method (see Migrator.measure)."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.measure(kind, method.__name__, params=repr(kwargs or args)) as record:
+                result = method(self, *args, **kwargs)
+                record['objects'] = self.loop_stats.get(method.__name__, {}).get('processed')
+            return result
+        return wrapper
+    return decorator
 
 
 class Migrator(object):
@@ -53,26 +146,209 @@ class Migrator(object):
         if disable_linkintegrity_checks:
             self.original_link_integrity = disable_link_integrity_checks()
         self.run_part = os.getenv('FUNC_PART', '')
+        self.checkpoint_parts = os.getenv('FUNC_CHECKPOINT', '0') == '1'
+        self.parallel_parts = set()
+        self.failed_parts = []
         self.display_mem = True
+        self.loop_stats = {}
+        # resources usage records of parts, upgrade steps, reindexes and reinstalls
+        self.stats = []
+        self.current_part = None
+        self.defers_reindexes = False
+        self.deferred_batch_size = 0
+        self.upgrades_cache = {}
+        self.resources_cache = {}
+        self.collects_schema_changes = False
+        self.import_contexts = {}
+        # used memory budget in Mb of the long loops (see MemoryGovernor), 0 to disable
+        self.mem_budget = int(os.getenv('FUNC_MEM_BUDGET', '0'))
+        # json report written by finish, if enabled with MIGRATOR_REPORT
+        self.report_file = report_dir() and os.path.join(report_dir(), self.report_filename()) or ''
+        # sampling profiler of the measured sections, enabled with FUNC_PROFILE (see profiler module)
+        self.profiler, self.owns_profiler = start_profiler()
 
     def run(self):
         """Must be overridden. This method does the migration job."""
         raise NotImplementedError('You should have overridden me darling.')
 
     def is_in_part(self, part):
-        """Check if environment variable part is the same as parameter."""
+        """Check if environment variable part is the same as parameter.
+           The resources usage of a part is recorded until the next part or the end.
+           If parts are checkpointed (FUNC_CHECKPOINT=1), a part done by a previous unfinished run or
+           by a parallel worker is skipped."""
         if self.run_part == part:
             logger.info("DOING PART '{}'".format(part))
-            return True
         elif self.run_part == '':
+            self.close_part()
+            if part in self.parallel_parts:
+                return False
+            if self.checkpoint_parts and part in self.done_parts():
+                logger.info("SKIPPING PART '{0}', already done on {1}".format(part, self.done_parts()[part]['done']))
+                return False
             self.log_mem("PART {}".format(part))  # print intermediate part memory info if run in one step
-            return True
-        return False
+        else:
+            return False
+        self.close_part()
+        self.current_part = self.start_measure('part', part)
+        return True
+
+    def migrator_id(self):
+        """Get the dotted name of the migrator class."""
+        return '{0}.{1}'.format(self.__class__.__module__, self.__class__.__name__)
+
+    def done_parts(self):
+        """Get the mapping of the checkpointed parts of this migrator, stored in a portal annotation.
+           It's an OOBTree so that parallel workers recording different parts don't conflict."""
+        annotations = IAnnotations(self.portal)
+        if PARTS_ANNOTATION_KEY not in annotations:
+            annotations[PARTS_ANNOTATION_KEY] = PersistentMapping()
+        parts = annotations[PARTS_ANNOTATION_KEY]
+        if self.migrator_id() not in parts:
+            parts[self.migrator_id()] = OOBTree()
+        return parts[self.migrator_id()]
+
+    def close_part(self):
+        """Close the current part: stop its measure and, if parts are checkpointed, commit its work then record
+           it as done in a separate transaction, so that the part is skipped if the migration is run again."""
+        record = self.current_part
+        if record is None:
+            return
+        self.current_part = None
+        self.stop_measure(record)
+        if self.checkpoint_parts:
+
+            def checkpoint():
+                self.done_parts()[record['name']] = {'seconds': record['wall'],
+                                                     'done': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+            # a conflict on the part work must be raised, the part is then not recorded as done
+            transaction.commit()
+            checkpoint()
+            # only the checkpoint transaction is done again on conflict
+            self.commit_and_minimize(redo=checkpoint)
+            logger.info("PART '{}' checkpointed".format(record['name']))
+
+    def run_parts_in_parallel(self, parts, instance=None):
+        """Run the independent p_parts in parallel Zope clients, each one running this migrator with FUNC_PART
+           set to a part. The parts are then skipped by is_in_part in this process.
+           Does nothing in a run limited to one part. Storage must be shared (ZEO or RelStorage).
+
+        :param parts: list of parts names
+        :param instance: instance script used to run workers (default is MIGRATOR_INSTANCE env or bin/instance)
+        :return: the merged workers report
+        """
+        if self.run_part:
+            return None
+        self.close_part()
+        parts = [part for part in parts if not (self.checkpoint_parts and part in self.done_parts())]
+        self.parallel_parts.update(parts)
+        transaction.commit()
+        tasks = [{'migrator': self.migrator_id(), 'method': 'run', 'env': {'FUNC_PART': part}} for part in parts]
+        logger.info("Running parts '{}' in parallel".format("', '".join(parts)))
+        report = merge_reports(run_workers(self.portal, tasks, instance=instance))
+        transaction.begin()
+        for failed in report['failed']:
+            self.failed_parts.append(parts[failed['id']])
+            self.warn(logger, "PART '{0}' failed: {1}".format(parts[failed['id']], failed['error']))
+        return report
+
+    def start_measure(self, kind, name, **info):
+        """Start recording the resources usage of a p_kind p_name section.
+           Returns the record, to be given to stop_measure."""
+        record = {'kind': kind, 'name': name, 'objects': None}
+        record.update(info)
+        record['_start'] = resource_usage(self.portal._p_jar)
+        self.stats.append(record)
+        if self.profiler is not None:
+            self.profiler.push('{0}:{1}'.format(kind, name))
+        return record
+
+    def stop_measure(self, record):
+        """Stop recording the resources usage in p_record, started with start_measure."""
+        if record is None or '_start' not in record:
+            return
+        start = record.pop('_start')
+        end = resource_usage(self.portal._p_jar)
+        if self.profiler is not None:
+            self.profiler.pop('{0}:{1}'.format(record['kind'], record['name']))
+        for key in ('wall', 'cpu', 'peak_rss', 'loads', 'stores'):
+            record[key] = round(end[key] - start[key], 3)
+        record['objects_per_second'] = record['objects'] and round(record['objects'] / (record['wall'] or 1), 1)
+
+    @contextlib.contextmanager
+    def measure(self, kind, name, **info):
+        """Context manager recording the resources usage of the enclosed code in self.stats.
+           The yielded record 'objects' key can be set to get the processed objects rate."""
+        record = self.start_measure(kind, name, **info)
+        try:
+            yield record
+        finally:
+            self.stop_measure(record)
+
+    def report_filename(self, suffix=''):
+        """Get a report file name, unique by process and migrator (nested migrators can be created in the same
+           second), ending with p_suffix."""
+        now = time.time()
+        return REPORT_FILENAME.format('{0}-{1:06d}_{2}_{3}{4}'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), int(now % 1 * 1000000), os.getpid(),
+            self.__class__.__name__, suffix))
+
+    def write_report(self):
+        """Write the resources usage records in self.report_file as json."""
+        if not self.stats or not self.report_file:
+            return
+        report = {'migrator': '{0}.{1}'.format(self.__class__.__module__, self.__class__.__name__),
+                  'start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.startTime)),
+                  'seconds': int(time.time() - self.startTime),
+                  'records': self.stats,
+                  'warnings': self.warnings}
+        with open(self.report_file, 'w') as fh:
+            json.dump(report, fh, indent=2, default=repr)
+        logger.info('Resources usage report written in {}'.format(self.report_file))
 
     def log_mem(self, tag=''):
-        """Display in Mb the used memory and in the fourth position of the 'quintet' the available memory"""
+        """Display in Mb the used memory and in the fourth position of the 'quintet' the available memory.
+           Returns the used memory in Mb."""
+        used = process_memory()
         if self.display_mem:
-            logger.info('Mem used {} at {}, ({})'.format(process_memory(), tag, memory()))
+            logger.info('Mem used {} at {}, ({})'.format(used, tag, memory()))
+        return used
+
+    def commit_and_minimize(self, redo=None, retries=3):
+        """Commit the current transaction and minimize the ZODB cache (committed objects are deactivated).
+           Used by long loops to keep the memory flat.
+           If p_redo is given, a ConflictError on commit aborts the transaction, calls p_redo to do again
+           the uncommitted work and retries the commit, at most p_retries times.
+           Returns the number of conflicts."""
+        conflicts = 0
+        while True:
+            try:
+                transaction.commit()
+                break
+            except ConflictError:
+                if redo is None or conflicts >= retries:
+                    raise
+                conflicts += 1
+                transaction.abort()
+                logger.warning('Conflict error on commit, doing the chunk again ({0}/{1})'.format(conflicts, retries))
+                redo()
+        self.portal._p_jar.cacheMinimize()
+        return conflicts
+
+    def governor(self, name, batch_size=0):
+        """Get a MemoryGovernor for the p_name loop committing every p_batch_size items, using the
+           FUNC_MEM_BUDGET memory budget."""
+        return MemoryGovernor(name, batch_size=batch_size, budget=self.mem_budget)
+
+    def progress(self, name, iterable=None, total=None):
+        """Get a Progress reporting the p_name loop on p_iterable of p_total items.
+           Can also be given as pghandler to catalog methods."""
+        return Progress(name, iterable, total=total)
+
+    def batch_loop(self, name, iterable, total=None, pklfile=None, batch_size=0, **kwargs):
+        """Get a BatchLoop for the p_name loop on p_iterable of p_total items, using batching with p_pklfile
+           and committing every p_batch_size items (see BatchLoop for the other parameters)."""
+        return BatchLoop(self, name, iterable, total=total, pklfile=pklfile, batch_size=batch_size, **kwargs)
 
     def warn(self, logger, warning_msg):
         """Manage warning messages, into logger and saved into self.warnings."""
@@ -85,23 +361,55 @@ class Migrator(object):
         if self.disable_linkintegrity_checks:
             restore_link_integrity_checks(self.original_link_integrity)
         self.request.set(CURRENTLY_MIGRATING_REQ_VALUE, False)
+        if self.collects_schema_changes:
+            self.apply_schema_changes()
+            self.request.set(SCHEMA_CHANGES_REQ_VALUE, None)
+        if self.defers_reindexes:
+            self.run_deferred_reindexes('finish', batch_size=self.deferred_batch_size)
+            self.request.set(DEFERRED_REINDEXES_REQ_VALUE, None)
         if not self.warnings:
             self.warnings.append('No warnings.')
         logger.info('HERE ARE WARNING MESSAGES GENERATED DURING THE MIGRATION : \n{0}'.format(
             '\n'.join(self.warnings)))
+        self.close_part()
+        parts = IAnnotations(self.portal).get(PARTS_ANNOTATION_KEY, {})
+        if self.checkpoint_parts and not self.run_part and self.migrator_id() in parts:
+            if self.failed_parts:
+                self.warn(logger, "Parts checkpoints kept, to run again the failed parts '{}'".format(
+                    "', '".join(self.failed_parts)))
+            else:
+                # the migration is fully done
+                del parts[self.migrator_id()]
+        self.write_report()
+        self.write_profile()
         logger.info(end_time(self.startTime))
 
+    def write_profile(self):
+        """Stop the sampling profiler if started by this migrator and write its results next to the report.
+           Also called by the sites runner when a migration failed before finish."""
+        if self.owns_profiler:
+            self.owns_profiler = False
+            stop_profiler(os.path.splitext(self.report_file or os.path.join(
+                os.getenv('INSTANCE_HOME', '.'), self.report_filename()))[0])
+
     def refreshDatabase(self,
                         catalogs=True,
                         catalogsToRebuild=['portal_catalog'],
                         workflows=False,
                         workflowsToUpdate=[],
-                        catalogsToUpdate=('portal_catalog', 'reference_catalog', 'uid_catalog')):
+                        catalogsToUpdate=('portal_catalog', 'reference_catalog', 'uid_catalog'),
+                        workflowsByCatalog=False,
+                        rebuildBatchSize=0,
+                        rebuildWorkers=0):
         """After the migration script has been executed, it can be necessary to
            update the Plone catalogs and/or the workflow settings on every
            database object if workflow definitions have changed. We can pass
            catalog ids we want to 'clear and rebuild' using
-           p_catalogsToRebuild."""
+           p_catalogsToRebuild.
+           If p_workflowsByCatalog, the objects of p_workflowsToUpdate are found
+           with the catalog instead of walking the whole site (see update_role_mappings).
+           If p_rebuildBatchSize or p_rebuildWorkers, the portal_catalog is rebuilt
+           by batches, possibly in parallel workers (see rebuildCatalog)."""
         if catalogs:
             # Manage the catalogs we want to clear and rebuild
             # We have to call another method as clear=1 passed to refreshCatalog
@@ -109,7 +417,11 @@ class Migrator(object):
             for catalogId in catalogsToRebuild:
                 logger.info('Clearing and rebuilding {0}...'.format(catalogId))
                 catalogObj = getattr(self.portal, catalogId)
-                if base_hasattr(catalogObj, 'clearFindAndRebuild'):
+                if catalogId == 'portal_catalog' and rebuildWorkers:
+                    self.rebuildCatalogParallel(workers=rebuildWorkers, batch_size=rebuildBatchSize or 1000)
+                elif catalogId == 'portal_catalog' and rebuildBatchSize:
+                    self.rebuildCatalog(batch_size=rebuildBatchSize)
+                elif base_hasattr(catalogObj, 'clearFindAndRebuild'):
                     catalogObj.clearFindAndRebuild()
                 else:
                     # special case for the uid_catalog
@@ -118,13 +430,15 @@ class Migrator(object):
                 if catalogId not in catalogsToRebuild:
                     logger.info('Refreshing {0}...'.format(catalogId))
                     catalogObj = getattr(self.portal, catalogId)
-                    pghandler = ZLogHandler()
-                    catalogObj.refreshCatalog(clear=0, pghandler=pghandler)
+                    catalogObj.refreshCatalog(clear=0, pghandler=self.progress('refreshCatalog'))
         if workflows:
             logger.info('Refresh workflow-related information on every object of the database...')
             if not workflowsToUpdate:
                 logger.info('Refreshing every workflows...')
                 count = self.wfTool.updateRoleMappings()
+            elif workflowsByCatalog:
+                self.update_role_mappings(workflowsToUpdate)
+                count = self.loop_stats['update_role_mappings']['updated']
             else:
                 wfs = {}
                 for wf_id in workflowsToUpdate:
@@ -135,42 +449,235 @@ class Migrator(object):
                 count = self.wfTool._recursiveUpdateRoleMappings(self.portal, wfs)
             logger.info('{0} object(s) updated.'.format(count))
 
-    def cleanRegistries(self, registries=('portal_javascripts', 'portal_css', 'portal_setup')):
+    def find_indexable(self, root, ids=None):
+        """Lazily yield (path, object) of the objects under p_root that can be indexed, like the find
+           done by clearFindAndRebuild. Containers are walked one child at a time. If p_ids is given, only
+           these sub-trees of p_root are walked."""
+        root_path = '/'.join(root.getPhysicalPath())
+        stack = [(root, root_path, iter(root.objectIds() if ids is None else ids))]
+        while stack:
+            container, container_path, children = stack[-1]
+            try:
+                child_id = next(children)
+            except StopIteration:
+                stack.pop()
+                continue
+            child = container._getOb(child_id, None)
+            if child is None:
+                continue
+            path = '{0}/{1}'.format(container_path, child_id)
+            if base_hasattr(child, 'indexObject'):
+                yield path, child
+            if base_hasattr(child, 'objectIds'):
+                stack.append((child, path, iter(child.objectIds())))
+
+    def index_found_object(self, obj):
+        """Index p_obj found by find_indexable, with its discussion comments, as done by clearFindAndRebuild."""
+        if not safe_callable(obj.indexObject):
+            return
+        try:
+            obj.indexObject()
+        except TypeError:
+            # catalogs have an indexObject method taking other parameters
+            return
+        if DISCUSSION_ANNOTATION_KEY is None:
+            return
+        annotations = IAnnotations(obj, None)
+        if annotations is not None and DISCUSSION_ANNOTATION_KEY in annotations:
+            conversation = annotations[DISCUSSION_ANNOTATION_KEY].__of__(obj)
+            for comment in conversation.getComments():
+                comment.indexObject()
+
+    @measured('reindex')
+    def rebuildCatalog(self, batch_size=1000, subtrees=None, clear=True, loop_length=None):
+        """Clear and rebuild the portal_catalog by batches, replacing clearFindAndRebuild.
+           The catalog is cleared if p_clear and if it's not a batching continuation.
+           A batch is indexed again if its commit raises a ConflictError.
+
+        :param batch_size: commit every batch_size indexed objects (no intermediate commit if 0)
+        :param subtrees: list of portal child ids to walk (all if None)
+        :param clear: clear the catalog before
+        :param loop_length: estimated number of objects to index, used by the progress (current catalog size if
+                            None). Batching gets the real number when all the objects have been found.
+        :return: True if batch_number is not defined, else return batch_last
+        """
+        catalog = api.portal.get_tool('portal_catalog')
+        pklfile = batch_hashed_filename('imio.migrator.rebuildCatalog.pkl', (subtrees, ))
+        if loop_length is None:
+            # estimated with the catalog size before it's cleared
+            loop_length = len(catalog._catalog)
+        loop = self.batch_loop('rebuildCatalog', self.find_indexable(self.portal, ids=subtrees), loop_length,
+                               pklfile=pklfile, batch_size=batch_size, key=lambda item: item[0],
+                               redo=lambda item: self.index_found_object(item[1]), estimated=True)
+        if clear and (loop.batch_keys is None or loop.batch_config['fr']):
+            logger.info('Clearing portal_catalog...')
+            catalog.manage_catalogClear()
+        loop.progress.info('In rebuildCatalog, subtrees={}'.format(repr(subtrees)))
+        for path, obj in loop:
+            self.index_found_object(obj)
+        logger.info('portal_catalog rebuilt with {} objects'.format(loop.progress.processed))
+        return loop.finished
+
+    def rebuildCatalogParallel(self, workers=4, instance=None, batch_size=1000):
+        """Clear the portal_catalog then rebuild it in p_workers Zope clients, each one walking some portal
+           sub-trees. Sub-trees are dispatched following their current catalog size.
+           The sub-trees of a failed worker are rebuilt again in this process, so an error stops the migration.
+           Storage must be shared (ZEO or RelStorage).
+
+        :param workers: number of worker processes
+        :param instance: instance script used to run workers (default is MIGRATOR_INSTANCE env or bin/instance)
+        :param batch_size: commit every batch_size objects in each worker
+        :return: the merged workers report
+        """
+        catalog = api.portal.get_tool('portal_catalog')
+        portal_path = '/'.join(self.portal.getPhysicalPath())
+        sizes = sorted([(len(catalog.unrestrictedSearchResults(path='{0}/{1}'.format(portal_path, child_id))),
+                         child_id) for child_id in self.portal.objectIds()], reverse=True)
+        shares = [[0, []] for nb in range(workers)]
+        for size, child_id in sizes:
+            # biggest sub-trees first, given to the less loaded worker
+            share = min(shares, key=lambda share: share[0])
+            share[0] += size or 1
+            share[1].append(child_id)
+        logger.info('Clearing portal_catalog...')
+        catalog.manage_catalogClear()
+        transaction.commit()
+        shares = [(size, ids) for (size, ids) in shares if ids]
+        # the sub-trees size is given as estimate, the catalog being empty
+        tasks = [{'method': 'rebuildCatalog',
+                  'kwargs': {'batch_size': batch_size, 'subtrees': ids, 'clear': False, 'loop_length': size}}
+                 for (size, ids) in shares]
+        logger.info('Running rebuildCatalog in {} workers'.format(len(tasks)))
+        reports = run_workers(self.portal, tasks, instance=instance)
+        report = merge_reports(reports)
+        report['finished'] = not [rep for rep in reports if not rep.get('error') and rep.get('result') is False]
+        transaction.begin()
+        for failed in report['failed']:
+            size, ids = shares[failed['id']]
+            self.warn(logger, 'rebuildCatalog worker {0} failed: {1}. Rebuilding its sub-trees {2} in this '
+                              'process'.format(failed['id'], failed['error'], ', '.join(ids)))
+            finished = self.rebuildCatalog(batch_size=batch_size, subtrees=ids, clear=False, loop_length=size)
+            report['finished'] = report['finished'] and finished
+        logger.info('rebuildCatalog workers indexed {processed} objects in {seconds} seconds'.format(**report))
+        return report
+
+    def workflow_portal_types(self, wf_ids):
+        """Get the portal_types bound to one of p_wf_ids workflows, by default or by a placeful policy."""
+        policies = []
+        placeful_tool = api.portal.get_tool('portal_placeful_workflow') \
+            if base_hasattr(self.portal, 'portal_placeful_workflow') else None
+        if placeful_tool is not None:
+            policies = placeful_tool.objectValues()
+        portal_types = []
+        for portal_type in api.portal.get_tool('portal_types').objectIds():
+            chain = list(self.wfTool.getChainForPortalType(portal_type))
+            for policy in policies:
+                chain.extend(policy.getChainFor(portal_type) or ())
+            if set(chain).intersection(wf_ids):
+                portal_types.append(portal_type)
+        return portal_types
+
+    @measured('workflow')
+    def update_role_mappings(self, wf_ids, batch_size=1000):
+        """Update the role mappings of p_wf_ids workflows on the objects whose portal_type is bound to them.
+           Objects are got with the catalog (uncataloged objects are not handled).
+           A commit is done every p_batch_size objects (no intermediate commit if 0).
+           Batching can be used to continue a previous run.
+           Only the allowedRolesAndUsers index of the objects whose role mappings changed is reindexed.
+           The number of updated objects is stored in loop_stats.
+
+        :return: True if batch_number is not defined, else return batch_last
+        """
+        wfs = dict([(wf_id, self.wfTool.getWorkflowById(wf_id)) for wf_id in wf_ids])
+        portal_types = self.workflow_portal_types(wf_ids)
+        if not portal_types:
+            # an empty portal_type query would match all the cataloged objects
+            logger.warning('update_role_mappings: no portal type bound to workflows "{}"'.format(', '.join(wf_ids)))
+            self.loop_stats['update_role_mappings'] = {'processed': 0, 'updated': 0, 'finished': True}
+            return True
+        catalog = api.portal.get_tool('portal_catalog')
+        rids = IITreeSet([brain.getRID() for brain in catalog.unrestrictedSearchResults(portal_type=portal_types)])
+        pklfile = batch_hashed_filename('imio.migrator.update_role_mappings.pkl', (wf_ids, ))
+        loop = self.batch_loop('update_role_mappings', rids, len(rids), pklfile=pklfile, batch_size=batch_size,
+                               key=catalog.getpath)
+        loop.progress.info('In update_role_mappings, workflows "{0}" on portal types "{1}"'.format(
+            ', '.join(wf_ids), ', '.join(portal_types)))
+        loop.stats['updated'] = 0
+        for rid in loop:
+            path = loop.current_key
+            obj = catalog.resolve_path(path)
+            if obj is None:
+                logger.error('update_role_mappings could not resolve an object from the uid %r.' % path)
+            else:
+                changed = False
+                for wf_id in self.wfTool.getChainFor(obj):
+                    if wf_id in wfs and wfs[wf_id].updateRoleMappingsFor(obj):
+                        changed = True
+                if changed:
+                    loop.stats['updated'] += 1
+                    catalog.catalog_object(obj, path, idxs=['allowedRolesAndUsers'], update_metadata=0)
+        return loop.finished
+
+    def resource_exists(self, resource_id):
+        """Check if p_resource_id can be traversed from the portal. Results depend on the site (skins, browser
+           layers), so they are cached for the migrator life: an id registered in several registries is
+           traversed once."""
+        if resource_id not in self.resources_cache:
+            self.resources_cache[resource_id] = bool(self.portal.restrictedTraverse(resource_id, False))
+        return self.resources_cache[resource_id]
+
+    def import_step_invalid(self, step_id):
+        """Check if the handler of p_step_id import step cannot be resolved. The handlers resolution is cached
+           for the process, so it's done once by handler when cleaning several sites."""
+        info = self.ps._import_registry.getStepMetadata(step_id)
+        if info is None:
+            # step registered globally
+            return self.ps.getImportStepMetadata(step_id)['invalid']
+        handler = info.get('handler')
+        if handler not in HANDLERS_CACHE:
+            HANDLERS_CACHE[handler] = bool(handler) and _resolveDottedName(handler) is not None
+        return not HANDLERS_CACHE[handler]
+
+    def cleanRegistries(self, registries=('portal_javascripts', 'portal_css', 'portal_setup'), all_sites=False):
         """
           Clean p_registries, remove not found elements.
+          Resources are cooked only if some were removed.
+          If p_all_sites, all the Plone sites of the Zope application are cleaned, with a commit after each site.
         """
+        if all_sites:
+            for site in get_plone_sites(self.portal.getPhysicalRoot()):
+                logger.info("Cleaning registries of site '{}'".format('/'.join(site.getPhysicalPath())))
+                setSite(site)
+                if aq_base(site) is aq_base(self.portal):
+                    self.cleanRegistries(registries=registries)
+                else:
+                    Migrator(site).cleanRegistries(registries=registries)
+                transaction.commit()
+            setSite(self.portal)
+            return
         logger.info('Cleaning registries...')
-        if 'portal_javascripts' in registries:
-            jstool = self.portal.portal_javascripts
-            for script in jstool.getResources():
-                scriptId = script.getId()
-                resourceExists = script.isExternal or self.portal.restrictedTraverse(scriptId, False) and True
-                if not resourceExists:
-                    # we found a notFound resource, remove it
-                    logger.info('Removing %s from portal_javascripts' % scriptId)
-                    jstool.unregisterResource(scriptId)
-            jstool.cookResources()
-            logger.info('portal_javascripts has been cleaned!')
-
-        if 'portal_css' in registries:
-            csstool = self.portal.portal_css
-            for sheet in csstool.getResources():
-                sheetId = sheet.getId()
-                resourceExists = sheet.isExternal or self.portal.restrictedTraverse(sheetId, False) and True
-                if not resourceExists:
+        for registry_id in ('portal_javascripts', 'portal_css'):
+            if registry_id not in registries:
+                continue
+            tool = getattr(self.portal, registry_id)
+            removed = False
+            for resource in tool.getResources():
+                resource_id = resource.getId()
+                if not resource.isExternal and not self.resource_exists(resource_id):
                     # we found a notFound resource, remove it
-                    logger.info('Removing %s from portal_css' % sheetId)
-                    csstool.unregisterResource(sheetId)
-            csstool.cookResources()
-            logger.info('portal_css has been cleaned!')
+                    logger.info('Removing %s from %s' % (resource_id, registry_id))
+                    tool.unregisterResource(resource_id)
+                    removed = True
+            if removed:
+                tool.cookResources()
+            logger.info('%s has been cleaned!' % registry_id)
 
         if 'portal_setup' in registries:
             # clean portal_setup
             change = False
             for stepId in self.ps.getSortedImportSteps():
-                stepMetadata = self.ps.getImportStepMetadata(stepId)
                 # remove invalid steps
-                if stepMetadata['invalid']:
+                if self.import_step_invalid(stepId):
                     logger.info('Removing %s step from portal_setup' % stepId)
                     self.ps._import_registry.unregisterStep(stepId)
                     change = True
@@ -180,17 +687,224 @@ class Migrator(object):
         logger.info('Registries have been cleaned!')
 
     def removeUnusedIndexes(self, indexes=[]):
-        """ Remove unused catalog indexes. """
+        """ Remove unused catalog indexes. Removal is scheduled if schema changes are collected. """
+        if self.schedule_schema_change(remove_indexes=indexes):
+            return
         logger.info('Removing no more used catalog indexes...')
         removeIndexes(self.portal, indexes=indexes)
         logger.info('Done.')
 
     def removeUnusedColumns(self, columns=[]):
-        """ Remove unused catalog columns. """
+        """ Remove unused catalog columns. Removal is scheduled if schema changes are collected. """
+        if self.schedule_schema_change(remove_columns=columns):
+            return
         logger.info('Removing no more used catalog columns...')
         removeColumns(self.portal, columns=columns)
         logger.info('Done.')
 
+    def collect_schema_changes(self):
+        """Start collecting the catalog schema changes, done by this migrator or by any migrator used in the same
+           request (as in upgrade steps run by upgradeAll). They are applied together by apply_schema_changes,
+           called when this migrator finishes."""
+        if self.request.get(SCHEMA_CHANGES_REQ_VALUE) is None:
+            self.request.set(SCHEMA_CHANGES_REQ_VALUE, {'add_indexes': {}, 'remove_indexes': [], 'add_columns': [],
+                                                        'remove_columns': []})
+            self.collects_schema_changes = True
+
+    def schedule_schema_change(self, add_indexes={}, remove_indexes=[], add_columns=[], remove_columns=[]):
+        """Schedule catalog schema changes, applied together by apply_schema_changes.
+           Returns False if schema changes are not collected (see collect_schema_changes).
+
+        :param add_indexes: dict {index name: (index type, extra)}, as for imio.helpers addOrUpdateIndexes.
+                            Existing indexes are kept.
+        :param remove_indexes: list of index names
+        :param add_columns: list of metadata names
+        :param remove_columns: list of metadata names
+        """
+        changes = self.request.get(SCHEMA_CHANGES_REQ_VALUE)
+        if changes is None:
+            return False
+        changes['add_indexes'].update(add_indexes)
+        for key, names in (('remove_indexes', remove_indexes), ('add_columns', add_columns),
+                           ('remove_columns', remove_columns)):
+            changes[key].extend([name for name in names if name not in changes[key]])
+        logger.info('Scheduled catalog schema changes: {}'.format(repr(changes)))
+        return True
+
+    @measured('reindex')
+    def apply_schema_changes(self, batch_size=1000):
+        """Apply the scheduled catalog schema changes.
+           Indexes are changed first. Then, in one pass committing every p_batch_size records, added indexes are
+           filled (without touching metadata) and metadata records are converted to the new schema in a separate
+           tree. The catalog keeps its old schema and records during the pass, so brains stay valid for other
+           processes. The new schema and records are published together at the end (see publish_schema_change).
+           The pass progress is stored on the catalog, so an interrupted pass is continued by the next call,
+           before the scheduled changes are applied.
+           Returns True."""
+        changes = self.request.get(SCHEMA_CHANGES_REQ_VALUE)
+        if changes is not None:
+            self.request.set(SCHEMA_CHANGES_REQ_VALUE, dict([(key, type(value)()) for key, value in changes.items()]))
+        catalog = api.portal.get_tool('portal_catalog')
+        zcatalog = catalog._catalog
+        progress = getattr(aq_base(zcatalog), SCHEMA_CHANGE_ATTR, None)
+        if progress is not None:
+            if 'data' not in progress or tuple(zcatalog.names) != progress['old_names']:
+                # records may already be in an unknown layout, converting them again could corrupt them
+                raise ValueError('Cannot continue the interrupted catalog schema change: metadata is {0} instead '
+                                 'of {1}. The catalog must be rebuilt.'.format(repr(zcatalog.names),
+                                                                               repr(progress['old_names'])))
+            logger.info('Continuing the interrupted catalog schema change before applying the scheduled changes')
+            self.convert_records(catalog, progress, batch_size=batch_size)
+        if not changes or not [value for value in changes.values() if value]:
+            return True
+        progress = self.change_schema(catalog, **changes)
+        if progress is None:
+            return True
+        return self.convert_records(catalog, progress, batch_size=batch_size)
+
+    def convert_records(self, catalog, progress, batch_size=1000):
+        """Do the apply_schema_changes pass of the schema change p_progress dict, from its last handled record,
+           then publish the new schema. Returns True."""
+        zcatalog = catalog._catalog
+
+        def save_progress():
+            progress['last_rid'] = loop.current_key
+            setattr(zcatalog, SCHEMA_CHANGE_ATTR, dict(progress))
+
+        loop = self.batch_loop('apply_schema_changes', iterate_keys(zcatalog.data, after=progress['last_rid']),
+                               len(zcatalog), batch_size=batch_size, before_commit=save_progress)
+        loop.progress.info('In apply_schema_changes, converting metadata from {0} to {1}, filling indexes {2}'.format(
+            repr(progress['old_names']), repr(progress['new_names']), repr(progress['new_indexes'])))
+        for rid in loop:
+            wrapper = None
+            if progress['new_indexes'] or progress['new_columns']:
+                wrapper = self.schema_change_wrapper(catalog, rid)
+            if wrapper is not None:
+                for name in progress['new_indexes']:
+                    zcatalog.getIndex(name).index_object(rid, wrapper)
+            progress['data'][rid] = self.convert_record(zcatalog.data[rid], progress, wrapper)
+        self.publish_schema_change(catalog, progress, batch_size=batch_size)
+        logger.info('Catalog schema changes applied on {} records'.format(loop.progress.processed))
+        return loop.finished
+
+    def change_schema(self, catalog, add_indexes={}, remove_indexes=[], add_columns=[], remove_columns=[]):
+        """Change the catalog indexes, without touching metadata schema and records.
+           Returns the schema change progress dict stored on the catalog, used by apply_schema_changes,
+           or None if records don't have to be handled."""
+        zcatalog = catalog._catalog
+        for name in remove_indexes:
+            if name in zcatalog.indexes:
+                catalog.delIndex(name)
+                logger.info('Removed index "%s"...' % name)
+        new_indexes = []
+        for name, (index_type, extra) in add_indexes.items():
+            if name in zcatalog.indexes:
+                logger.info('Index "%s" already exists' % name)
+                continue
+            if index_type == 'ZCTextIndex' and not extra:
+                extra = ZCTextIndexInfo()
+            catalog.addIndex(name, index_type, extra)
+            new_indexes.append(name)
+            logger.info('Added index "%s" of type "%s"...' % (name, index_type))
+        old_names = tuple(zcatalog.names)
+        new_columns = [name for name in add_columns if name not in old_names]
+        names = tuple([name for name in old_names if name not in remove_columns] + new_columns)
+        if names == old_names and not new_indexes:
+            return None
+        progress = {'old_names': old_names, 'new_names': names, 'new_indexes': new_indexes,
+                    'new_columns': new_columns, 'last_rid': None, 'data': IOBTree()}
+        setattr(zcatalog, SCHEMA_CHANGE_ATTR, progress)
+        transaction.commit()
+        return progress
+
+    def schema_change_wrapper(self, catalog, rid):
+        """Get the indexable wrapper of the object cataloged with p_rid, or None if it cannot be resolved."""
+        path = catalog._catalog.paths.get(rid)
+        obj = None
+        if path is not None:
+            obj = catalog.resolve_path(path)
+        if obj is None:
+            logger.error('apply_schema_changes could not resolve an object from the uid %r.' % path)
+            return None
+        return self.indexable(catalog, obj)
+
+    def convert_record(self, record, progress, wrapper=None):
+        """Convert a metadata p_record from the old to the new names of the schema change p_progress dict.
+           Added columns are computed on the indexable p_wrapper, as the catalog does (missing value if None)."""
+        old_positions = dict([(name, pos) for pos, name in enumerate(progress['old_names'])])
+        values = []
+        for name in progress['new_names']:
+            if name in old_positions:
+                values.append(record[old_positions[name]])
+                continue
+            value = MV
+            if wrapper is not None:
+                value = getattr(wrapper, name, MV)
+            if value is not MV and safe_callable(value):
+                value = value()
+            values.append(value)
+        return tuple(values)
+
+    def publish_schema_change(self, catalog, progress, batch_size=1000, retries=5):
+        """Publish the new metadata schema and the records converted by apply_schema_changes.
+           Records cataloged again by other processes since their conversion (their kept columns changed) or
+           added meanwhile are first converted again and records uncataloged meanwhile are dropped, committing
+           every p_batch_size records (see catch_up_records). This is repeated while the catalog counter changes,
+           at most p_retries times. Only the swap of the records tree and schema is done in the last transaction."""
+        zcatalog = catalog._catalog
+        for attempt in range(retries):
+            counter = catalog.getCounter()
+            again = self.catch_up_records(catalog, progress, batch_size=batch_size)
+            if catalog.getCounter() != counter:
+                logger.info('Catalog changed while converting records again, doing it again')
+                continue
+            zcatalog.data = progress['data']
+            zcatalog.schema = dict([(name, pos) for pos, name in enumerate(progress['new_names'])])
+            zcatalog.names = tuple(progress['new_names'])
+            zcatalog.updateBrains()
+            delattr(zcatalog, SCHEMA_CHANGE_ATTR)
+            try:
+                self.commit_and_minimize()
+            except ConflictError:
+                transaction.abort()
+                logger.warning('Conflict error on the catalog schema swap, converting changed records again')
+                continue
+            logger.info('Changed metadata from {0} to {1}, {2} records converted again'.format(
+                repr(progress['old_names']), repr(zcatalog.names), again))
+            return
+        raise ValueError('The catalog schema change could not be published: the catalog is changed by other '
+                         'processes. It will be continued by the next apply_schema_changes call.')
+
+    def catch_up_records(self, catalog, progress, batch_size=1000):
+        """Convert again the records of the schema change p_progress dict whose kept columns changed since their
+           conversion or added since, and drop the converted records uncataloged since. A commit is done every
+           p_batch_size records. Returns the number of converted records."""
+        zcatalog = catalog._catalog
+        new_data = progress['data']
+        old_positions = dict([(name, pos) for pos, name in enumerate(progress['old_names'])])
+        new_positions = dict([(name, pos) for pos, name in enumerate(progress['new_names'])])
+        kept = [name for name in progress['new_names'] if name in old_positions]
+        loop = self.batch_loop('catch_up_records', iterate_keys(zcatalog.data), len(zcatalog),
+                               batch_size=batch_size)
+        loop.stats['converted'] = 0
+        for rid in loop:
+            record = zcatalog.data[rid]
+            new_record = new_data.get(rid)
+            if new_record is not None and [record[old_positions[name]] for name in kept] == \
+                    [new_record[new_positions[name]] for name in kept]:
+                continue
+            wrapper = None
+            if progress['new_columns']:
+                wrapper = self.schema_change_wrapper(catalog, rid)
+            new_data[rid] = self.convert_record(record, progress, wrapper)
+            loop.stats['converted'] += 1
+        loop = self.batch_loop('catch_up_records_drop', iterate_keys(new_data), len(new_data),
+                               batch_size=batch_size)
+        for rid in loop:
+            if rid not in zcatalog.data:
+                del new_data[rid]
+        return self.loop_stats['catch_up_records']['converted']
+
     def removeUnusedPortalTypes(self, portal_types=[]):
         """ Remove unused portal_types from portal_types and portal_factory."""
         logger.info('Removing no more used {0} portal_types...'.format(', '.join(portal_types)))
@@ -213,91 +927,397 @@ class Migrator(object):
         props.manage_changeProperties(types_not_searched=tuple(nsTypes))
         logger.info('Done.')
 
-    def clean_orphan_brains(self, query):
-        """Get brains from catalog with p_query and clean brains without an object."""
-        brains = list(self.catalog(**query))
-        pghandler = ZLogHandler(steps=1000)
-        pghandler.init('clean_orphan_brains', len(brains))
-        pghandler.info('Cleaning orphan brains (query=%s)' % query)
-        i = 0
-        cleaned = 0
-        for brain in brains:
-            i += 1
-            pghandler.report(i)
-            path = brain.getPath()
-            try:
-                brain.getObject()
-            except AttributeError:
+    def unwoken_object(self, path, containers=None):
+        """Get the object at p_path without waking it up: only its containers are loaded.
+           p_containers is an optional dict used as cache of the already got containers.
+           Returns None if no object is stored at p_path."""
+        container_path, obj_id = path.rsplit('/', 1)
+        if containers is not None and container_path in containers:
+            container = containers[container_path]
+        else:
+            container = self.portal.unrestrictedTraverse(container_path, None)
+            if containers is not None:
+                containers[container_path] = container
+        if container is None:
+            return None
+        base = aq_base(container)
+        if base_hasattr(base, '_tree'):
+            # BTreeFolder2
+            return base._tree.get(obj_id)
+        elif base_hasattr(base, 'objectIds'):
+            if obj_id in base.objectIds():
+                return getattr(base, obj_id)
+            return None
+        # not an object manager, we traverse
+        return container.unrestrictedTraverse(obj_id, None)
+
+    def oid_sorted_paths(self, paths):
+        """Sort p_paths following their object oid, without waking objects up.
+           Paths whose object is not found are put at the end."""
+        containers = {}
+        with_oid = []
+        for path in paths:
+            obj = self.unwoken_object(path, containers)
+            with_oid.append((getattr(obj, '_p_oid', None) or b'\xff' * 8, path))
+        with_oid.sort()
+        return [path for (oid, path) in with_oid]
+
+    @measured('reindex')
+    def clean_orphan_brains(self, query, batch_size=0):
+        """Get brains from catalog with p_query and clean brains without an object.
+           Objects existence is checked without waking them up. A commit is done every p_batch_size brains
+           (no intermediate commit if 0). Batching can be used to continue a previous run.
+
+        :return: True if batch_number is not defined, else return batch_last
+        """
+        # only rids are kept, brains are released before the loop
+        rids = IITreeSet([brain.getRID() for brain in self.catalog(**query)])
+        pklfile = batch_hashed_filename('imio.migrator.clean_orphan_brains.pkl', (query, ))
+        # containers are released with the ZODB cache at each commit
+        containers = {}
+        loop = self.batch_loop('clean_orphan_brains', rids, len(rids), pklfile=pklfile, batch_size=batch_size,
+                               key=self.catalog.getpath, before_commit=containers.clear)
+        loop.progress.info('Cleaning orphan brains (query=%s)' % query)
+        loop.stats['cleaned'] = 0
+        for rid in loop:
+            path = loop.current_key
+            if self.unwoken_object(path, containers) is None:
                 logger.warning("Uncataloging object at %s" % path)
                 self.catalog.uncatalog_object(path)
-                cleaned += 1
-        pghandler.finish()
-        logger.warning("clean_orphan_brains cleaned %d orphan brains" % cleaned)
+                loop.stats['cleaned'] += 1
+        logger.warning("clean_orphan_brains cleaned %d orphan brains" % loop.stats['cleaned'])
         logger.info('Done.')
+        return loop.finished
+
+    def filtered_rids(self, catalog, **filters):
+        """Get the catalog rids matching p_filters, without waking any object.
+
+        :param catalog: the catalog tool
+        :param filters: index name as key and list of values as value. An empty list means no filter.
+                        The index with the same name is used, or else the metadata column.
+        :return: an IITreeSet of rids, or None if no filter could be applied
+        """
+        zcatalog = catalog._catalog
+        result = None
+        for name, values in filters.items():
+            if not values:
+                continue
+            rids = IITreeSet()
+            index = zcatalog.indexes.get(name)
+            if index is not None and base_hasattr(index, '_index'):
+                for value in values:
+                    found = index._index.get(value)
+                    if found is None:
+                        continue
+                    if isinstance(found, int):
+                        rids.insert(found)
+                    else:
+                        rids.update(found)
+            elif name in zcatalog.schema:
+                pos = zcatalog.schema[name]
+                for rid, record in zcatalog.data.items():
+                    if record[pos] in values:
+                        rids.insert(rid)
+            else:
+                logger.warning("Cannot filter catalog on '{}': no index or metadata with that name".format(name))
+                continue
+            result = rids if result is None else intersection(result, rids)
+        return result
+
+    def indexable(self, catalog, obj):
+        """Get the indexable wrapper of p_obj, as used by the catalog when indexing."""
+        if IIndexableObject.providedBy(obj):
+            return obj
+        wrapper = queryMultiAdapter((obj, catalog), IIndexableObject)
+        return wrapper if wrapper is not None else obj
+
+    def changed_indexes(self, catalog, obj, rid, idxs=[]):
+        """Get the indexes of p_idxs (all indexes if empty) whose stored value differs from the p_obj value.
+           Only simple FieldIndex, KeywordIndex and UUIDIndex are compared, other indexes are always returned."""
+        wrapper = self.indexable(catalog, obj)
+        changed = []
+        for name in idxs or catalog.indexes():
+            index = catalog._catalog.getIndex(name)
+            attrs = index.getIndexSourceNames()
+            if index.meta_type not in DIFFABLE_INDEX_TYPES or len(attrs) != 1 or rid is None:
+                changed.append(name)
+                continue
+            stored = index._unindex.get(rid, None)
+            try:
+                if index.meta_type == 'KeywordIndex':
+                    same = stored is not None and set(index._get_object_keywords(wrapper, attrs[0])) == set(stored)
+                else:
+                    same = stored is not None and index._get_object_datum(wrapper, attrs[0]) == stored
+            except Exception:
+                # the index will handle it
+                same = False
+            if not same:
+                changed.append(name)
+        return changed
 
-    def reindexIndexes(self, idxs=[], update_metadata=False, meta_types=[], portal_types=[]):
+    def catalog_object_if_changed(self, catalog, obj, path, idxs=[], update_metadata=False):
+        """Catalog p_obj on p_idxs (all indexes if empty) only if an indexed value has changed.
+           The indexes already don't write an unchanged value: what is saved is the whole catalog_object call
+           (catalog counter increment, values of the other indexes) for objects without any changed value.
+           Metadata are then updated directly if p_update_metadata (the record is only written if different, the
+           catalog counter being then incremented).
+           When a value has changed, only the changed indexes are given to catalog_object (but their value is
+           computed twice).
+           Returns True if the object was not cataloged."""
+        rid = catalog._catalog.uids.get(path)
+        changed = self.changed_indexes(catalog, obj, rid, idxs or catalog.indexes())
+        if changed:
+            catalog.catalog_object(obj, path, idxs=changed, update_metadata=update_metadata)
+            return False
+        if update_metadata:
+            record = catalog._catalog.data.get(rid)
+            catalog._catalog.updateMetadata(self.indexable(catalog, obj), path, rid)
+            if catalog._catalog.data.get(rid) != record:
+                # as catalog_object does, for the caches keyed on the catalog counter
+                catalog._increment_counter()
+        return True
+
+    @measured('reindex')
+    def reindexIndexes(self, idxs=[], update_metadata=False, meta_types=[], portal_types=[], chunk_size=0,
+                       max_mem=0, shard=None, skip_unchanged=False):
         """Reindex index including metadata if p_update_metadata=True.
 
         :param idxs: list of indexes to handle
         :param update_metadata: also reindex metadata
         :param meta_types: list of meta_types to filter on
         :param portal_types: list of portal_types to filter on
+        :param chunk_size: if > 0, commit every chunk_size objects and minimize the ZODB cache.
+                           A chunk is done again if its commit raises a ConflictError.
+                           The size is adapted if a memory budget is defined (see MemoryGovernor).
+        :param max_mem: if > 0, stop the loop when the used memory (in Mb) is still higher after a chunk commit.
+                        The loop can be continued later with batching. Needs p_chunk_size or a memory budget
+                        (a ValueError is raised otherwise).
+        :param shard: (shard number, shards count) tuple to only handle a part of the catalog paths
+        :param skip_unchanged: don't catalog the objects without changed index value
+                               (see catalog_object_if_changed)
         :return: True if batch_number is not defined, else return batch_last
         """
+        if not shard:
+            query = dict([(key, value) for key, value in (('meta_type', meta_types), ('portal_type', portal_types))
+                          if value]) or None
+            if self.register_reindex(query, idxs=idxs, update_metadata=update_metadata, caller='reindexIndexes',
+                                     ignored={'chunk_size': chunk_size, 'max_mem': max_mem,
+                                              'skip_unchanged': skip_unchanged}):
+                return True
         catalog = api.portal.get_tool('portal_catalog')
-        paths = list(catalog._catalog.uids.keys())
-        pghandler = ZLogHandler(steps=1000)
-        i = 0
-        pghandler.info(
-            'In reindexIndexes, idxs={0}, update_metadata={1}, meta_types={2}, portal_types={3}'.format(
-                repr(idxs), repr(update_metadata), repr(meta_types), repr(portal_types)))
-        pghandler.init('reindexIndexes', len(paths))
-        pklfile = batch_hashed_filename('imio.migrator.reindexIndexes.pkl',
-                                        (idxs, update_metadata, meta_types, portal_types))
-        batch_keys, batch_config = batch_get_keys(pklfile, loop_length=len(paths), log=True)
-        for p in paths:
-            if batch_skip_key(p, batch_keys, batch_config):
-                continue
-            i += 1
-            if pghandler:
-                pghandler.report(i)
+        # candidates are filtered on indexes or metadata, so only matching objects are waked up
+        rids = self.filtered_rids(catalog, meta_type=meta_types, portal_type=portal_types)
+
+        def candidates():
+            if rids is None:
+                # uids keys are walked lazily to avoid loading all paths in memory
+                return iterate_keys(catalog._catalog.uids)
+            return (catalog._catalog.paths[rid] for rid in rids)
+
+        paths = candidates()
+        len_paths = len(catalog._catalog) if rids is None else len(rids)
+        to_hash = (idxs, update_metadata, meta_types, portal_types)
+        if shard:
+            shard = tuple(shard)
+            to_hash += (shard, )
+            len_paths = sum(1 for p in candidates() if in_shard(p, shard))
+            paths = (p for p in paths if in_shard(p, shard))
+        pklfile = batch_hashed_filename('imio.migrator.reindexIndexes.pkl', to_hash)
+
+        def reindex(p):
             obj = catalog.resolve_path(p)
             if obj is None:
                 logger.error('reindexIndex could not resolve an object from the uid %r.' % p)
             elif (not meta_types or obj.meta_type in meta_types) and \
                  (not portal_types or obj.portal_type in portal_types):
-                catalog.catalog_object(obj, p, idxs=idxs, update_metadata=update_metadata, pghandler=pghandler)
-            if batch_handle_key(p, batch_keys, batch_config):
-                break
-        else:
-            batch_loop_else(batch_keys, batch_config)
-        if pghandler:
-            pghandler.finish()
-        if can_delete_batch_files(batch_keys, batch_config):
-            batch_delete_files(batch_keys, batch_config, log=True)
-            return True
-        return batch_globally_finished(batch_keys, batch_config)
+                if skip_unchanged:
+                    loop.stats['skipped'] += self.catalog_object_if_changed(catalog, obj, p, idxs=idxs,
+                                                                            update_metadata=update_metadata)
+                else:
+                    catalog.catalog_object(obj, p, idxs=idxs, update_metadata=update_metadata,
+                                           pghandler=loop.progress)
+
+        loop = self.batch_loop('reindexIndexes', paths, len_paths, pklfile=pklfile, batch_size=chunk_size,
+                               redo=reindex, max_mem=max_mem)
+        loop.progress.info(
+            'In reindexIndexes, idxs={0}, update_metadata={1}, meta_types={2}, portal_types={3}, shard={4}'.format(
+                repr(idxs), repr(update_metadata), repr(meta_types), repr(portal_types), repr(shard)))
+        loop.stats['skipped'] = 0
+        for p in loop:
+            reindex(p)
+        if skip_unchanged:
+            logger.info('reindexIndexes did not catalog {} objects without changed index value'.format(
+                loop.stats['skipped']))
+        return loop.finished
 
-    def reindexIndexesFor(self, idxs=[], **query):
-        """ Reindex p_idxs on objects of given p_portal_types. """
+    def reindexIndexesParallel(self, workers=4, instance=None, chunk_size=1000, **kwargs):
+        """Run reindexIndexes in p_workers Zope clients, each one handling a shard of the catalog paths.
+           Storage must be shared (ZEO or RelStorage). The current transaction is committed first so that
+           workers see it.
+
+        :param workers: number of worker processes
+        :param instance: instance script used to run workers (default is MIGRATOR_INSTANCE env or bin/instance)
+        :param chunk_size: commit every chunk_size objects in each worker
+        :param kwargs: reindexIndexes parameters
+        :return: the merged workers report
+        """
+        transaction.commit()
+        kwargs['chunk_size'] = chunk_size
+        tasks = [{'method': 'reindexIndexes', 'kwargs': dict(kwargs, shard=(nb, workers))}
+                 for nb in range(workers)]
+        logger.info('Running reindexIndexes in {} workers ({})'.format(workers, repr(kwargs)))
+        report = merge_reports(run_workers(self.portal, tasks, instance=instance))
+        # see workers changes
+        transaction.begin()
+        for failed in report['failed']:
+            self.warn(logger, 'reindexIndexes worker {0} failed: {1}'.format(failed['id'], failed['error']))
+        logger.info('reindexIndexes workers handled {processed} objects with {conflicts} conflicts in '
+                    '{seconds} seconds'.format(**report))
+        return report
+
+    @measured('reindex')
+    def reindexIndexesFor(self, idxs=[], skip_unchanged=False, batch_size=0, oid_order=False, **query):
+        """ Reindex p_idxs on objects of given p_portal_types.
+            If p_skip_unchanged, objects without changed index value are not cataloged and metadata are not
+            updated (see catalog_object_if_changed).
+            A commit is done every p_batch_size objects (no intermediate commit if 0).
+            Batching can be used to continue a previous run.
+            If p_oid_order, objects are handled in their storage order (oid) so ZODB reads are mostly sequential.
+
+        :return: True if batch_number is not defined, else return batch_last
+        """
+        # deferred, objects are still found by a catalog query and reindexed by reindexObject
+        if self.register_reindex(query, idxs=idxs, update_metadata=True, caller='reindexIndexesFor',
+                                 ignored={'skip_unchanged': skip_unchanged, 'batch_size': batch_size,
+                                          'oid_order': oid_order}, reindex_object=True):
+            return True
         catalog = api.portal.get_tool('portal_catalog')
-        brains = catalog(**query)
-        pghandler = ZLogHandler(steps=1000)
-        len_brains = len(brains)
-        pghandler.info(
+        # only rids are kept, brains are released before the loop
+        rids = IITreeSet([brain.getRID() for brain in catalog(**query)])
+        len_brains = len(rids)
+        paths = (catalog.getpath(rid) for rid in rids)
+        if oid_order:
+            paths = self.oid_sorted_paths(paths)
+        pklfile = batch_hashed_filename('imio.migrator.reindexIndexesFor.pkl', (idxs, skip_unchanged, query))
+        loop = self.batch_loop('reindexIndexesFor', paths, len_brains, pklfile=pklfile, batch_size=batch_size)
+        loop.progress.info(
             'In reindexIndexesFor, reindexing indexes "{0}" on "{1}" objects ({2})...'.format(
                 ', '.join(idxs) or '*',
-                len(brains),
+                len_brains,
                 str(query)))
-        pghandler.init('reindexIndexesFor', len_brains)
-        i = 0
-        for brain in brains:
-            i += 1
-            pghandler.report(i)
-            obj = brain.getObject()
-            obj.reindexObject(idxs=idxs)
-        pghandler.finish()
+        loop.stats['skipped'] = 0
+        for path in loop:
+            obj = catalog.resolve_path(path)
+            if obj is None:
+                logger.error('reindexIndexesFor could not resolve an object from the path %r.' % path)
+            elif skip_unchanged:
+                loop.stats['skipped'] += self.catalog_object_if_changed(catalog, obj, path, idxs=idxs)
+            else:
+                obj.reindexObject(idxs=idxs)
+        if skip_unchanged:
+            logger.info('reindexIndexesFor did not catalog {} objects without changed index value'.format(
+                loop.stats['skipped']))
         logger.info('Done.')
+        return loop.finished
+
+    def defer_reindexes(self, batch_size=0):
+        """Start deferring the reindexIndexes and reindexIndexesFor calls, done by this migrator or by any
+           migrator used in the same request (as in upgrade steps run by upgradeAll).
+           The deferred reindexes are merged and done in one catalog pass by run_deferred_reindexes,
+           at a checkpoint or when this migrator finishes, committing every p_batch_size objects
+           (no intermediate commit if 0)."""
+        if self.request.get(DEFERRED_REINDEXES_REQ_VALUE) is None:
+            self.request.set(DEFERRED_REINDEXES_REQ_VALUE, [])
+            self.defers_reindexes = True
+            self.deferred_batch_size = batch_size
+
+    def register_reindex(self, query=None, idxs=[], update_metadata=False, caller='', ignored={},
+                         reindex_object=False):
+        """Register a deferred reindex of p_idxs (all indexes if empty) on objects matching p_query
+           (all objects if None). Returns False if reindexes are not deferred.
+           If p_reindex_object, p_query is a restricted catalog query and objects are reindexed by their
+           reindexObject method, as reindexIndexesFor does (notifyModified when all indexes are reindexed,
+           other catalogs of Archetypes objects updated). Otherwise objects are found by an unrestricted query
+           and cataloged directly in portal_catalog, as reindexIndexes does.
+           The p_caller method stats are reset and its p_ignored parameters (name: value) are logged
+           if they are set."""
+        queue = self.request.get(DEFERRED_REINDEXES_REQ_VALUE)
+        if queue is None:
+            return False
+        logger.info('Deferring reindex of "{0}" on objects matching {1}, update_metadata={2}'.format(
+            ', '.join(idxs) or '*', repr(query), repr(update_metadata)))
+        ignored = sorted([(name, value) for name, value in ignored.items() if value])
+        if ignored:
+            logger.warning('{0} parameters ignored by the deferred reindex: {1}'.format(
+                caller, ', '.join(['{0}={1}'.format(name, repr(value)) for name, value in ignored])))
+        if caller:
+            self.loop_stats[caller] = {'processed': 0, 'deferred': True}
+        queue.append({'query': query, 'idxs': list(idxs), 'update_metadata': update_metadata,
+                      'reindex_object': reindex_object})
+        return True
+
+    @measured('reindex')
+    def run_deferred_reindexes(self, checkpoint='', batch_size=0):
+        """Do the deferred reindexes in one catalog pass: each object is cataloged once on the union of
+           the indexes requested for it (reindexObject is called first for requests registered with
+           reindex_object, the indexes it did not cover are then cataloged directly).
+           Reindexes are still deferred after.
+
+        :param checkpoint: name of the checkpoint, used in logs and batching file name
+        :param batch_size: commit every batch_size objects (no intermediate commit if 0)
+        :return: True if batch_number is not defined, else return batch_last
+        """
+        queue = self.request.get(DEFERRED_REINDEXES_REQ_VALUE)
+        if not queue:
+            return True
+        self.request.set(DEFERRED_REINDEXES_REQ_VALUE, [])
+        catalog = api.portal.get_tool('portal_catalog')
+        requests = []
+        for request in queue:
+            # queries are evaluated now to get the current objects
+            rids = None
+            if request['query'] is not None:
+                search = request['reindex_object'] and catalog.searchResults or catalog.unrestrictedSearchResults
+                rids = IITreeSet([brain.getRID() for brain in search(**request['query'])])
+            requests.append((rids, request['idxs'], request['update_metadata'], request['reindex_object']))
+        if [request for request in requests if request[0] is None]:
+            all_rids = iterate_keys(catalog._catalog.paths)
+            len_rids = len(catalog._catalog)
+        else:
+            all_rids = multiunion([request[0] for request in requests])
+            len_rids = len(all_rids)
+        pklfile = batch_hashed_filename('imio.migrator.run_deferred_reindexes.pkl', (checkpoint, queue))
+        loop = self.batch_loop('run_deferred_reindexes', all_rids, len_rids, pklfile=pklfile, batch_size=batch_size,
+                               key=catalog.getpath)
+        loop.progress.info('In run_deferred_reindexes at "{0}", merging {1} reindexes'.format(checkpoint, len(queue)))
+        loop.stats['merged'] = len(queue)
+        for rid in loop:
+            path = loop.current_key
+            # merged requests by reindex_object value: [requested, all indexes, indexes]
+            merged = {True: [False, False, set()], False: [False, False, set()]}
+            obj_update_metadata = False
+            for rids, idxs, update_metadata, reindex_object in requests:
+                if rids is None or rid in rids:
+                    merged[reindex_object][0] = True
+                    merged[reindex_object][1] = merged[reindex_object][1] or not idxs
+                    merged[reindex_object][2].update(idxs)
+                    obj_update_metadata = obj_update_metadata or update_metadata
+            obj = catalog.resolve_path(path)
+            if obj is None:
+                logger.error('run_deferred_reindexes could not resolve an object from the uid %r.' % path)
+                continue
+            requested, all_idxs, obj_idxs = merged[False]
+            if merged[True][0]:
+                obj.reindexObject(idxs=not merged[True][1] and sorted(merged[True][2]) or [])
+                # reindexObject updated the metadata and these indexes
+                requested = requested and not merged[True][1] and (all_idxs or bool(obj_idxs - merged[True][2]))
+                obj_idxs = obj_idxs - merged[True][2]
+                obj_update_metadata = False
+            if requested:
+                catalog.catalog_object(obj, path, idxs=not all_idxs and list(obj_idxs) or [],
+                                       update_metadata=obj_update_metadata)
+        logger.info('Merged {0} reindexes in one pass on {1} objects'.format(len(queue), loop.progress.processed))
+        return loop.finished
 
     def install(self, products):
         """ Allows to install a series of products """
@@ -306,41 +1326,146 @@ class Migrator(object):
             logger.info("Install product '{}'".format(product))
             logger.info(qi.installProduct(product, forceProfile=True))  # don't reinstall
 
-    def reinstall(self, profiles, ignore_dependencies=False, dependency_strategy=None):
-        """ Allows to reinstall a series of p_profiles. """
+    def reinstall(self, profiles, ignore_dependencies=False, dependency_strategy=None, combined=False,
+                  skip_unchanged=False):
+        """ Allows to reinstall a series of p_profiles.
+            If p_combined, the import steps of all the profiles are run with run_import_steps: each profile
+            is imported once with a cached context and the not installed dependencies are imported before
+            (p_dependency_strategy is not used). Unchanged steps are skipped if p_skip_unchanged. """
         logger.info('Reinstalling product(s) %s...' % ', '.join([profile.startswith('profile-') and profile[8:]
                                                                  or profile for profile in profiles]))
+        if combined:
+            plan = []
+            for profile in profiles:
+                chain = [profile]
+                if not ignore_dependencies:
+                    chain = [dep for dep in self.ps.getProfileDependencyChain(profile)
+                             if self.ps.getLastVersionForProfile(dep) == 'unknown'] + chain
+                plan.extend([(dep, None) for dep in chain])
+            self.run_import_steps(plan, skip_unchanged=skip_unchanged)
+            logger.info('Done.')
+            return
         for profile in profiles:
             if not profile.startswith('profile-'):
                 profile = 'profile-%s' % profile
             try:
-                self.ps.runAllImportStepsFromProfile(profile,
-                                                     ignore_dependencies=ignore_dependencies,
-                                                     dependency_strategy=dependency_strategy)
+                with self.measure('reinstall', profile):
+                    self.ps.runAllImportStepsFromProfile(profile,
+                                                         ignore_dependencies=ignore_dependencies,
+                                                         dependency_strategy=dependency_strategy)
             except KeyError:
                 logger.error('Profile %s not found!' % profile)
         logger.info('Done.')
 
+    def import_context(self, profile_id):
+        """Get the import context of p_profile_id, cached during the migration.
+           The profile import steps are registered when the context is created."""
+        if profile_id not in self.import_contexts:
+            context = self.ps._getImportContext(profile_id, None, None)
+            self.ps.applyContext(context)
+            self.import_contexts[profile_id] = context
+        return self.import_contexts[profile_id]
+
+    def step_files_hash(self, context, step_id):
+        """Get a hash of the files read by p_step_id in the profile of p_context (see IMPORT_STEP_FILES).
+           Returns None if the step files are unknown or if the profile is not a directory."""
+        base = getattr(context, '_profile_path', None)
+        if step_id not in IMPORT_STEP_FILES or base is None:
+            return None
+        sha = hashlib.sha1()
+        for name in IMPORT_STEP_FILES[step_id]:
+            path = os.path.join(base, name)
+            paths = [path] if os.path.isfile(path) else \
+                sorted([os.path.join(dirpath, filename) for dirpath, dirnames, filenames in os.walk(path)
+                        for filename in filenames])
+            for file_path in paths:
+                sha.update(os.path.relpath(file_path, base).encode('utf8'))
+                with open(file_path, 'rb') as fh:
+                    sha.update(fh.read())
+        return sha.hexdigest()
+
+    def run_import_steps(self, plan, skip_unchanged=False):
+        """Run the import steps of p_plan, each (profile, step) only once, with cached import contexts.
+           The files hash of each run step is stored on the portal.
+
+        :param plan: list of (profile_id, step_ids) tuples. If step_ids is None, all the import steps are run
+                     and the profile import events are notified, like runAllImportStepsFromProfile.
+        :param skip_unchanged: skip the steps whose files didn't change since their last run
+                               (only for steps with known files, see IMPORT_STEP_FILES)
+        :return: the list of run 'profile:step'
+        """
+        annotations = IAnnotations(self.portal)
+        if IMPORT_STEPS_ANNOTATION_KEY not in annotations:
+            annotations[IMPORT_STEPS_ANNOTATION_KEY] = PersistentMapping()
+        hashes = annotations[IMPORT_STEPS_ANNOTATION_KEY]
+        seen = set()
+        done = []
+        for profile_id, step_ids in plan:
+            if profile_id.startswith('profile-'):
+                profile_id = profile_id[8:]
+            try:
+                context = self.import_context('profile-{}'.format(profile_id))
+            except KeyError:
+                logger.error('Profile %s not found!' % profile_id)
+                continue
+            full = step_ids is None
+            if full:
+                step_ids = self.ps.getSortedImportSteps()
+                # prefixed like runAllImportStepsFromProfile, as expected by the GenericSetup handlers
+                notify(BeforeProfileImportEvent(self.ps, 'profile-{}'.format(profile_id), step_ids, True))
+            for step_id in step_ids:
+                key = '{0}:{1}'.format(profile_id, step_id)
+                if key in seen:
+                    continue
+                seen.add(key)
+                files_hash = self.step_files_hash(context, step_id)
+                if skip_unchanged and files_hash is not None and hashes.get(key) == files_hash:
+                    logger.info("Skipping unchanged import step '{}'".format(key))
+                    continue
+                logger.info("Running import step '{}'".format(key))
+                with self.measure('import_step', key):
+                    self.ps._doRunImportStep(step_id, context)
+                if files_hash is not None:
+                    hashes[key] = files_hash
+                done.append(key)
+            if full:
+                # the profile version is recorded by the GenericSetup handler
+                notify(ProfileImportedEvent(self.ps, 'profile-{}'.format(profile_id), step_ids, True))
+        return done
+
+    def list_upgrades(self, profile, show_old=False):
+        """Cached portal_setup.listUpgrades. The cache is renewed when the profile version changes."""
+        key = (profile, show_old)
+        version = self.ps.getLastVersionForProfile(profile)
+        if key not in self.upgrades_cache or self.upgrades_cache[key][0] != version:
+            self.upgrades_cache[key] = (version, self.ps.listUpgrades(profile, show_old=show_old))
+        return self.upgrades_cache[key][1]
+
+    def pending_steps(self, profile, olds=[]):
+        """Get the upgrade steps infos to run for p_profile, as a list of dicts with 'step', 'ssource'
+           and 'sdest' keys. olds can contain a list of dest upgrades to run."""
+        # if olds, we get all steps.
+        steps = []
+        for container in self.list_upgrades(profile, show_old=bool(olds)):
+            if isinstance(container, dict):
+                container = [container]
+            for dic in container:
+                if not olds or dic['sdest'] in olds:
+                    steps.append(dic)
+        return steps
+
     def upgradeProfile(self, profile, olds=[]):
         """ Get upgrade steps and run it. olds can contain a list of dest upgrades to run. """
 
         def run_upgrade_step(step, source, dest):
             logger.info('Running upgrade step %s (%s -> %s): %s' % (profile, source, dest, step.title))
-            step.doStep(self.ps)
+            with self.measure('upgrade_step', '{0}:{1}'.format(profile, dest), source=source, title=step.title):
+                step.doStep(self.ps)
 
-        # if olds, we get all steps.
-        upgrades = self.ps.listUpgrades(profile, show_old=bool(olds))
         applied_dests = []
-        for container in upgrades:
-            if isinstance(container, dict):
-                if not olds or container['sdest'] in olds:
-                    applied_dests.append((normalize_version(container['sdest']), container['sdest']))
-                    run_upgrade_step(container['step'], container['ssource'], container['sdest'])
-            elif isinstance(container, list):
-                for dic in container:
-                    if not olds or dic['sdest'] in olds:
-                        applied_dests.append((normalize_version(dic['sdest']), dic['sdest']))
-                        run_upgrade_step(dic['step'], dic['ssource'], dic['sdest'])
+        for dic in self.pending_steps(profile, olds=olds):
+            applied_dests.append((normalize_version(dic['sdest']), dic['sdest']))
+            run_upgrade_step(dic['step'], dic['ssource'], dic['sdest'])
         if applied_dests:
             current_version = normalize_version(self.ps.getLastVersionForProfile(profile))
             highest_version, dest = sorted(applied_dests)[-1]
@@ -358,17 +1483,99 @@ class Migrator(object):
                 except AttributeError as e:
                     logger.error("Cannot get product '%s' from portal_quickinstaller: %s" % (product, e))
 
-    def upgradeAll(self, omit=[]):
-        """ Upgrade all upgrade profiles except those in omit parameter list """
+    def order_profiles(self, profiles):
+        """Order p_profiles so that a profile comes after the profiles it depends on (metadata.xml)."""
+        ordered = []
+
+        def add(profile, seen):
+            if profile in ordered or profile in seen:
+                return
+            seen.add(profile)
+            try:
+                dependencies = self.ps.getDependenciesForProfile(profile) or ()
+            except KeyError:
+                dependencies = ()
+            for dependency in dependencies:
+                if dependency.startswith('profile-'):
+                    dependency = dependency[8:]
+                if dependency in profiles:
+                    add(dependency, seen)
+            ordered.append(profile)
+
+        for profile in profiles:
+            add(profile, set())
+        return ordered
+
+    def past_durations(self):
+        """Get the average duration in seconds of the upgrade steps recorded in the previous reports."""
+        durations = {}
+        if not report_dir():
+            return durations
+        pattern = os.path.join(report_dir(), REPORT_FILENAME.format('*'))
+        for report_file in glob.glob(pattern):
+            try:
+                with open(report_file) as fh:
+                    records = json.load(fh)['records']
+            except (IOError, ValueError, KeyError):
+                continue
+            for record in records:
+                if record.get('kind') == 'upgrade_step' and 'wall' in record:
+                    durations.setdefault(record['name'], []).append(record['wall'])
+        return dict([(name, sum(walls) / len(walls)) for name, walls in durations.items()])
+
+    def pending_profiles(self, omit=[]):
+        """Get the installed profiles, not in p_omit, having pending upgrade steps, ordered following profiles
+           dependencies."""
+        profiles = [profile for profile in self.ps.listProfilesWithUpgrades()
+                    # make sure the profile isn't the current (or must be avoided) and
+                    # the profile is well installed
+                    if profile not in omit and self.ps.getLastVersionForProfile(profile) != 'unknown']
+        return [profile for profile in self.order_profiles(profiles) if self.pending_steps(profile)]
+
+    def plan_upgrades(self, omit=[]):
+        """Get the pending upgrade steps of all installed profiles, ordered following profiles dependencies.
+
+        :param omit: profiles to skip
+        :return: list of dicts with 'profile', 'source', 'dest', 'title' and 'estimate' (average seconds in the
+                 previous reports, None if unknown) keys
+        """
+        durations = self.past_durations()
+        plan = []
+        for profile in self.pending_profiles(omit=omit):
+            for dic in self.pending_steps(profile):
+                plan.append({'profile': profile, 'source': dic['ssource'], 'dest': dic['sdest'],
+                             'title': dic['step'].title,
+                             'estimate': durations.get('{0}:{1}'.format(profile, dic['sdest']))})
+        return plan
+
+    def upgradeAll(self, omit=[], dry_run=False):
+        """ Upgrade all upgrade profiles except those in omit parameter list.
+            Profiles are upgraded following their dependencies. The profiles still pending are got again after
+            each upgraded profile, so the returned plan can differ from what is done.
+            If p_dry_run, nothing is done but the plan is logged with estimated durations. Returns the plan."""
+        omit = list(omit)
         if self.portal.REQUEST.get('profile_id'):
             omit.append(self.portal.REQUEST.get('profile_id'))
-        for profile in self.ps.listProfilesWithUpgrades():
-            # make sure the profile isn't the current (or must be avoided) and
-            # the profile is well installed
-            if profile not in omit and self.ps.getLastVersionForProfile(profile) != 'unknown':
-                self.upgradeProfile(profile)
+        plan = self.plan_upgrades(omit=omit)
+        if dry_run:
+            known = [step['estimate'] for step in plan if step['estimate'] is not None]
+            for step in plan:
+                logger.info('Planned upgrade step {profile} ({source} -> {dest}): {title}, estimate={estimate}'
+                            .format(**step))
+            logger.info('{0} upgrade steps planned, estimated to {1} seconds ({2} without estimate)'.format(
+                len(plan), int(sum(known)), len(plan) - len(known)))
+            return plan
+        # pending profiles are got again after each profile, as an upgrade step can install or upgrade profiles
+        done = []
+        profiles = self.pending_profiles(omit=omit)
+        while profiles:
+            self.upgradeProfile(profiles[0])
+            done.append(profiles[0])
+            profiles = self.pending_profiles(omit=omit + done)
+        return plan
 
-    def runProfileSteps(self, product, steps=[], profile='default', run_dependencies=False):
+    def runProfileSteps(self, product, steps=[], profile='default', run_dependencies=False, combined=False,
+                        skip_unchanged=False):
         """Run given steps of a product profile (default is 'default' profile).
 
         :param product: product name
@@ -376,7 +1583,21 @@ class Migrator(object):
         :param profile: profile name (default is 'default')
         :param run_dependencies: run first level of step dependencies (not dependencies of dependencies)
                                  (default is False)
+        :param combined: run the steps with run_import_steps: a step shared by several steps dependencies
+                         is run once and the profile context is cached
+        :param skip_unchanged: in combined mode, skip the steps whose files didn't change since their last run
         """
+        if combined:
+            profile_id = 'profile-%s:%s' % (product, profile)
+            step_ids = []
+            for step_id in steps:
+                if run_dependencies:
+                    self.import_context(profile_id)
+                    # local and global (zcml) registries
+                    step_ids.extend((self.ps.getImportStepMetadata(step_id) or {}).get('dependencies', ()))
+                step_ids.append(step_id)
+            logger.info("Running profile steps '%s:%s' => %s" % (product, profile, ', '.join(step_ids)))
+            return self.run_import_steps([(profile_id, step_ids)], skip_unchanged=skip_unchanged)
         for step_id in steps:
             logger.info("Running profile step '%s:%s' => %s" % (product, profile, step_id))
             self.ps.runImportStepFromProfile('profile-%s:%s' % (product, profile), step_id,
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------------------
+# GNU General Public License (GPL)
+# ------------------------------------------------------------------------------
+"""
+Sampling profiler of the Migrator measured sections (parts, upgrade steps, reindexes, import steps, ...).
+
+Enabled with the FUNC_PROFILE env variable:
+
+* FUNC_PROFILE=1 or FUNC_PROFILE=cpu samples the stack every FUNC_PROFILE_INTERVAL ms (default 5) of cpu time;
+* FUNC_PROFILE=wall samples on wall clock time, so time waiting for the storage is included.
+
+System calls interrupted by the timer signal are restarted (see signal.siginterrupt).
+
+Each sample is attributed to the innermost open section. At the end, a per section hotspot summary and a
+collapsed stacks file (to be given to flamegraph.pl or speedscope) are written.
+"""
+
+import collections
+import logging
+import os
+import signal
+
+
+logger = logging.getLogger('imio.migrator')
+TIMERS = {'cpu': ('ITIMER_PROF', 'SIGPROF'), 'wall': ('ITIMER_REAL', 'SIGALRM')}
+NO_SECTION = '(no section)'
+_profiler = None
+
+
+def frame_label(frame):
+    """Get the label of a sampled p_frame (function name, file name, first line number) tuple."""
+    name, filename, line = frame
+    return '{0} ({1}:{2})'.format(name, '/'.join(filename.split(os.sep)[-2:]), line)
+
+
+class SamplingProfiler(object):
+    """Sample the main thread stack with a signal timer and count the stacks by open section."""
+
+    def __init__(self, mode='cpu', interval=0.005):
+        self.mode = mode
+        self.interval = interval
+        self.sections = []
+        # section name: {(open sections, stack frames): samples count}
+        self.samples = collections.OrderedDict()
+        self.previous_handler = None
+
+    def start(self):
+        """Start the timer. Returns False if signal timers cannot be used here."""
+        timer_name, signal_name = TIMERS[self.mode]
+        if not hasattr(signal, 'setitimer') or not hasattr(signal, signal_name):
+            logger.warning('Sampling profiler not available on this platform')
+            return False
+        try:
+            self.previous_handler = signal.signal(getattr(signal, signal_name), self.sample)
+        except ValueError:
+            logger.warning('Sampling profiler can only be started in the main thread')
+            return False
+        # restart the system calls interrupted by a sample instead of failing with EINTR
+        signal.siginterrupt(getattr(signal, signal_name), False)
+        signal.setitimer(getattr(signal, timer_name), self.interval, self.interval)
+        logger.info('Sampling profiler started ({0}, every {1} ms)'.format(self.mode, self.interval * 1000))
+        return True
+
+    def stop(self):
+        """Stop the timer and restore the previous signal handler."""
+        timer_name, signal_name = TIMERS[self.mode]
+        signal.setitimer(getattr(signal, timer_name), 0)
+        signal.signal(getattr(signal, signal_name), self.previous_handler or signal.SIG_DFL)
+
+    def push(self, name):
+        """Open the p_name section."""
+        self.sections.append(name)
+
+    def pop(self, name):
+        """Close the p_name section (and the inner sections not closed)."""
+        if name in self.sections:
+            del self.sections[len(self.sections) - 1 - self.sections[::-1].index(name):]
+
+    def sample(self, signum, frame):
+        """Signal handler counting the interrupted stack."""
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        section = self.sections and self.sections[-1] or NO_SECTION
+        counts = self.samples.setdefault(section, collections.defaultdict(int))
+        counts[(tuple(self.sections), tuple(stack[::-1]))] += 1
+
+    def hotspots(self, top=20):
+        """Get the hotspots summary text: by section, the functions with the most samples on top of the stack
+           (own time) and in the stack (cumulative time)."""
+        lines = []
+        for section, counts in self.samples.items():
+            total = sum(counts.values())
+            own = collections.defaultdict(int)
+            cumulative = collections.defaultdict(int)
+            for (sections, frames), count in counts.items():
+                if not frames:
+                    continue
+                own[frame_label(frames[-1])] += count
+                for func in set([frame_label(frame) for frame in frames]):
+                    cumulative[func] += count
+            lines.append('{0}: {1} samples, ~{2:.2f} s'.format(section, total, total * self.interval))
+            for title, stats in (('own', own), ('cumulative', cumulative)):
+                lines.append('  {}:'.format(title))
+                for func, count in sorted(stats.items(), key=lambda item: item[1], reverse=True)[:top]:
+                    lines.append('    {0:6.1f}% {1:7d}  {2}'.format(count * 100.0 / total, count, func))
+            lines.append('')
+        return '\n'.join(lines)
+
+    def write(self, prefix):
+        """Write the hotspots summary in p_prefix.hotspots.txt and the collapsed stacks in p_prefix.collapsed.
+           Returns the written files paths."""
+        hotspots_file = '{}.hotspots.txt'.format(prefix)
+        with open(hotspots_file, 'w') as fh:
+            fh.write(self.hotspots())
+        collapsed_file = '{}.collapsed'.format(prefix)
+        with open(collapsed_file, 'w') as fh:
+            for counts in self.samples.values():
+                for (sections, frames), count in counts.items():
+                    # open sections are the stacks roots in the flame graph
+                    names = list(sections) + [frame_label(frame) for frame in frames]
+                    fh.write('{0} {1}\n'.format(';'.join([name.replace(';', ',') for name in names]), count))
+        logger.info('Profile written in {0} and {1}'.format(hotspots_file, collapsed_file))
+        return hotspots_file, collapsed_file
+
+
+def start_profiler():
+    """Start the process profiler following FUNC_PROFILE env variable, if not yet started.
+       Returns the profiler (None if profiling is disabled) and True if it has been started by this call."""
+    global _profiler
+    mode = os.getenv('FUNC_PROFILE', '0')
+    if _profiler is not None:
+        return _profiler, False
+    if mode in ('', '0'):
+        return None, False
+    if mode == '1':
+        mode = 'cpu'
+    if mode not in TIMERS:
+        logger.warning("Unknown FUNC_PROFILE mode '{}'".format(mode))
+        return None, False
+    profiler = SamplingProfiler(mode, float(os.getenv('FUNC_PROFILE_INTERVAL', '5')) / 1000)
+    if not profiler.start():
+        return None, False
+    _profiler = profiler
+    return profiler, True
+
+
+def stop_profiler(prefix):
+    """Stop the process profiler and write its results with p_prefix (see SamplingProfiler.write)."""
+    global _profiler
+    if _profiler is None:
+        return None
+    profiler, _profiler = _profiler, None
+    profiler.stop()
+    return profiler.write(prefix)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------------------
+# GNU General Public License (GPL)
+# ------------------------------------------------------------------------------
+"""
+Progress reporting of the Migrator long loops.
+
+A Progress wraps the loop iterable and emits, at most every interval seconds, an event with the handled items
+count, the rate, a moving average based ETA and the used memory. Events are given to sinks:
+
+* LogSink logs a line;
+* JsonLinesSink appends a json line to a file;
+* StatusFileSink overwrites a json file with the last event, to be watched while the loop runs.
+
+Sinks are configured with the MIGRATOR_PROGRESS env variable, like "log,jsonl:/tmp/progress.jsonl,status:/tmp/st"
+and the interval with MIGRATOR_PROGRESS_INTERVAL (default 30 seconds).
+"""
+from imio.pyutils.system import process_memory
+
+import json
+import logging
+import os
+import time
+
+
+logger = logging.getLogger('imio.migrator')
+
+
+class LogSink(object):
+    """Log the progress events."""
+
+    def __init__(self, logger=logger):
+        self.logger = logger
+
+    def emit(self, event):
+        if event['event'] == 'info':
+            self.logger.info('{0}: {1}'.format(event['name'], event['msg']))
+            return
+        msg = '{name}: {event} {done}/{total} ({percent}%), {rate} items/s, elapsed {elapsed}s'.format(**event)
+        if event['eta'] is not None:
+            msg += ', ETA {}s'.format(event['eta'])
+        self.logger.info('{0}, mem {1} Mb'.format(msg, event['memory']))
+
+
+class JsonLinesSink(object):
+    """Append the progress events as json lines in p_path."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, event):
+        with open(self.path, 'a') as fh:
+            fh.write(json.dumps(event) + '\n')
+
+
+class StatusFileSink(object):
+    """Write the last progress event as json in p_path."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, event):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(event, fh, indent=2)
+        os.rename(tmp_path, self.path)
+
+
+def get_sinks(config=None):
+    """Get the sinks following p_config (default is MIGRATOR_PROGRESS env variable or 'log')."""
+    if config is None:
+        config = os.getenv('MIGRATOR_PROGRESS', 'log')
+    sinks = []
+    for part in config.split(','):
+        kind, sep, path = part.strip().partition(':')
+        if kind == 'log':
+            sinks.append(LogSink())
+        elif kind == 'jsonl' and path:
+            sinks.append(JsonLinesSink(path))
+        elif kind == 'status' and path:
+            sinks.append(StatusFileSink(path))
+        elif kind:
+            logger.warning("Unknown progress sink '{}'".format(part))
+    return sinks
+
+
+class Progress(object):
+    """Report the progress of a loop on p_iterable, or of a catalog method when used as progress handler
+       (init, report, info and finish methods of the ZCatalog progress handler interface).
+
+    :param name: name of the loop
+    :param iterable: the looped items (can be None when used as progress handler)
+    :param total: expected number of items (ETA is not computed if None)
+    :param sinks: list of objects with an emit method receiving event dicts (see get_sinks if None)
+    :param interval: minimum seconds between two progress events (MIGRATOR_PROGRESS_INTERVAL env if None)
+    :param smoothing: weight of the last interval rate in the moving average rate
+    """
+
+    def __init__(self, name, iterable=None, total=None, sinks=None, interval=None, smoothing=0.3):
+        self.name = name
+        self.iterable = iterable
+        self.total = total
+        self.sinks = get_sinks() if sinks is None else sinks
+        if interval is None:
+            interval = float(os.getenv('MIGRATOR_PROGRESS_INTERVAL', '30'))
+        self.interval = interval
+        self.smoothing = smoothing
+        self.done = 0
+        self.skipped = 0
+        self.rate = None
+        self.start = self.last_time = time.time()
+        self.last_processed = 0
+        self.started = False
+
+    @property
+    def processed(self):
+        """Number of handled items, excluding the skipped ones."""
+        return self.done - self.skipped
+
+    def __iter__(self):
+        self.init(self.name, self.total)
+        for item in self.iterable:
+            # counted before being handled, like the loop counters, so a break doesn't miss the last item
+            self.done += 1
+            if time.time() - self.last_time >= self.interval:
+                self.emit('progress')
+            yield item
+
+    def skip(self):
+        """Count the current item as skipped (as a batching already done key)."""
+        self.skipped += 1
+
+    def init(self, ident, max=None):
+        """Start the progress."""
+        if self.started:
+            return
+        self.started = True
+        self.name = ident
+        if max is not None:
+            self.total = max
+        self.start = self.last_time = time.time()
+        self.emit('start')
+
+    def report(self, current, *args, **kw):
+        """Set the handled items count to p_current."""
+        self.done = current
+        if time.time() - self.last_time >= self.interval:
+            self.emit('progress')
+
+    def info(self, text):
+        """Emit an info message."""
+        event = {'event': 'info', 'name': self.name, 'msg': text, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        for sink in self.sinks:
+            sink.emit(event)
+
+    def finish(self):
+        """End the progress."""
+        self.emit('finish')
+
+    def emit(self, kind):
+        """Update the moving average rate and emit a p_kind event to the sinks."""
+        now = time.time()
+        if now > self.last_time and self.processed > self.last_processed:
+            # skipped items are fast, they are not used in the rate
+            rate = (self.processed - self.last_processed) / (now - self.last_time)
+            self.rate = rate if self.rate is None else self.smoothing * rate + (1 - self.smoothing) * self.rate
+        self.last_time = now
+        self.last_processed = self.processed
+        eta = None
+        if self.total and self.rate and kind == 'progress':
+            eta = int(max(self.total - self.done, 0) / self.rate)
+        event = {'event': kind, 'name': self.name, 'done': self.done, 'skipped': self.skipped,
+                 'total': self.total, 'percent': self.total and round(self.done * 100.0 / self.total, 1),
+                 'rate': self.rate and round(self.rate, 1), 'elapsed': int(now - self.start), 'eta': eta,
+                 'memory': process_memory(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        for sink in self.sinks:
+            sink.emit(event)
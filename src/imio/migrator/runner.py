@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------------------
+# GNU General Public License (GPL)
+# ------------------------------------------------------------------------------
+"""
+Run a Migrator on all the Plone sites of a Zope application, in one Zope process or in a bounded pool of
+Zope clients. Used as script:
+
+    bin/instance run runner.py my.package.migrations.Migrate_To_X [workers]
+"""
+from Acquisition import aq_base
+from imio.migrator.migrator import CURRENTLY_MIGRATING_REQ_VALUE
+from imio.migrator.migrator import DEFERRED_REINDEXES_REQ_VALUE
+from imio.migrator.migrator import SCHEMA_CHANGES_REQ_VALUE
+from imio.migrator.utils import end_time
+from imio.migrator.utils import get_plone_sites
+from imio.migrator.workers import run_workers
+from imio.migrator.workers import setup_app
+from zope.component.hooks import setSite
+
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+import transaction
+
+
+logger = logging.getLogger('imio.migrator')
+SITES_REPORT_FILENAME = 'imio.migrator.sites_report_{}.json'
+
+
+def run_on_sites(app, migrator_class, sites=None, workers=0, instance=None, report_file=None):
+    """Run p_migrator_class on Plone sites, one after the other in this process (ZCA, imports and caches stay
+       warm), or dispatched on p_workers Zope clients. Each site is run in its own transaction.
+       The migrator run method must call finish.
+
+    :param app: the Zope application
+    :param migrator_class: the Migrator class
+    :param sites: list of sites paths (all the Plone sites of p_app if None)
+    :param workers: if > 0, number of Zope clients on which sites are dispatched. Storage must be shared.
+    :param instance: instance script used to run workers (default is MIGRATOR_INSTANCE env or bin/instance)
+    :param report_file: json file where the summary is written (default in INSTANCE_HOME, no file if empty)
+    :return: the summary dict with 'sites' (per site 'seconds', 'warnings', 'records' and 'error'),
+             'failed' and 'seconds' keys
+    """
+    start = time.time()
+    if sites is None:
+        sites = ['/'.join(site.getPhysicalPath()) for site in get_plone_sites(app)]
+    summary = {'sites': {}, 'failed': []}
+    if workers:
+        dotted = '{0}.{1}'.format(migrator_class.__module__, migrator_class.__name__)
+        tasks = [{'migrator': dotted, 'sites': sites[nb::workers]} for nb in range(workers) if sites[nb::workers]]
+        for report in run_workers('', tasks, instance=instance):
+            summary['sites'].update(report.get('sites', {}))
+            summary['failed'].extend(report.get('failed', []))
+            if not report.get('sites'):
+                summary['failed'].extend(tasks[report['id']]['sites'])
+    else:
+        for site_path in sites:
+            summary['sites'][site_path] = run_on_site(app, migrator_class, site_path)
+            if summary['sites'][site_path]['error']:
+                summary['failed'].append(site_path)
+    summary['seconds'] = int(time.time() - start)
+    logger.info('Migrated {0} sites, {1} failed: {2}'.format(len(sites), len(summary['failed']),
+                                                             ', '.join(summary['failed'])))
+    logger.info(end_time(start, base_msg='Sites migration finished in '))
+    if report_file is None:
+        report_file = os.path.join(os.getenv('INSTANCE_HOME', '.'),
+                                   SITES_REPORT_FILENAME.format(time.strftime('%Y%m%d-%H%M%S')))
+    if report_file:
+        with open(report_file, 'w') as fh:
+            json.dump(summary, fh, indent=2, default=repr)
+    return summary
+
+
+def new_request_app(app):
+    """Get p_app wrapped with a new request, so that request values and request caches of a site migration
+       are not seen by the next one."""
+    from Testing.makerequest import makerequest
+    from zope.globalrequest import setRequest
+
+    app = makerequest(aq_base(app))
+    setRequest(app.REQUEST)
+    return app
+
+
+def run_on_site(app, migrator_class, site_path):
+    """Run p_migrator_class on the site at p_site_path, in its own transaction and with its own request.
+       Returns the site report."""
+    start = time.time()
+    report = {'error': None, 'warnings': [], 'records': []}
+    logger.info("Migrating site '{}'".format(site_path))
+    migrator = None
+    app = new_request_app(app)
+    try:
+        site = app.unrestrictedTraverse(str(site_path))
+        setSite(site)
+        migrator = migrator_class(site)
+        if migrator.report_file:
+            migrator.report_file = os.path.join(os.path.dirname(migrator.report_file),
+                                                migrator.report_filename('_{}'.format(site.getId())))
+        migrator.run()
+        transaction.commit()
+    except Exception:
+        transaction.abort()
+        report['error'] = traceback.format_exc()
+        logger.error("Migration of site '{0}' failed:\n{1}".format(site_path, report['error']))
+    finally:
+        # a failed migration may not have called finish
+        for key in (CURRENTLY_MIGRATING_REQ_VALUE, DEFERRED_REINDEXES_REQ_VALUE, SCHEMA_CHANGES_REQ_VALUE):
+            app.REQUEST.set(key, None)
+        if migrator is not None:
+            # the next site must not inherit the profiler timer
+            migrator.write_profile()
+        setSite(None)
+    if migrator is not None:
+        report['warnings'] = migrator.warnings
+        report['records'] = migrator.stats
+    report['seconds'] = int(time.time() - start)
+    # keep the cache of the next site warm but not too big
+    app._p_jar.cacheMinimize()
+    return report
+
+
+if __name__ == '__main__':
+    from zope.dottedname.resolve import resolve
+    # 'app' is defined by 'instance run'
+    run_on_sites(setup_app(app), resolve(sys.argv[1]),  # noqa: F821
+                 workers=len(sys.argv) > 2 and int(sys.argv[2]) or 0)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from imio.migrator import governor
+from imio.migrator.governor import MemoryGovernor
+
+import unittest
+
+
+class TestMemoryGovernor(unittest.TestCase):
+
+    def setUp(self):
+        self.used = 100
+        self.process_memory = governor.process_memory
+        governor.process_memory = lambda: self.used
+
+    def tearDown(self):
+        governor.process_memory = self.process_memory
+
+    def test_inactive(self):
+        gov = MemoryGovernor('test')
+        self.assertFalse(gov.active)
+        self.assertFalse([nb for nb in range(1000) if gov.step()])
+        self.assertEqual(gov.commits, 0)
+
+    def test_batch_size(self):
+        gov = MemoryGovernor('test', batch_size=10)
+        self.assertTrue(gov.active)
+        self.assertEqual([nb for nb in range(35) if gov.step()], [9, 19, 29])
+        self.assertEqual(gov.commits, 3)
+        self.assertEqual(gov.count, 5)
+        # no budget, the batch size is kept
+        self.assertEqual(gov.batch_size, 10)
+
+    def test_budget_exceeded(self):
+        gov = MemoryGovernor('test', budget=500, min_batch_size=10, check_interval=0)
+        self.assertTrue(gov.active)
+        self.assertFalse([nb for nb in range(20) if gov.step()])
+        self.used = 600
+        # memory is not checked before min_batch_size items
+        self.assertTrue(gov.step())
+        self.assertEqual(gov.commits, 1)
+        self.assertEqual(gov.batch_size, 10)
+        self.assertFalse([nb for nb in range(9) if gov.step()])
+
+    def test_check_interval(self):
+        gov = MemoryGovernor('test', budget=500, min_batch_size=1, check_interval=3600)
+        self.used = 600
+        self.assertFalse([nb for nb in range(100) if gov.step()])
+
+    def test_adapt(self):
+        gov = MemoryGovernor('test', batch_size=100, budget=1000, min_batch_size=10, max_batch_size=130)
+        self.used = 900
+        self.assertTrue([nb for nb in range(100) if gov.step()])
+        self.assertEqual(gov.batch_size, 50)
+        self.used = 100
+        gov.last_rate = 0
+        self.assertTrue([nb for nb in range(50) if gov.step()])
+        self.assertEqual(gov.batch_size, 62)
+        gov.resize(120)
+        gov.last_rate = 0
+        self.assertTrue([nb for nb in range(120) if gov.step()])
+        self.assertEqual(gov.batch_size, 130)
+        gov.resize(10)
+        self.used = 900
+        self.assertTrue([nb for nb in range(10) if gov.step()])
+        self.assertEqual(gov.batch_size, 10)
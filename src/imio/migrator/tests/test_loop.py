@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from imio.migrator.governor import MemoryGovernor
+from imio.migrator.loop import BatchLoop
+from imio.migrator.progress import Progress
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class FakeMigrator(object):
+    """Migrator part used by BatchLoop, recording the commits."""
+
+    def __init__(self):
+        self.loop_stats = {}
+        self.commits = []
+        self.conflicts = 0
+        self.used = 0
+
+    def progress(self, name, iterable=None, total=None):
+        return Progress(name, iterable, total=total, sinks=[])
+
+    def governor(self, name, batch_size=0):
+        return MemoryGovernor(name, batch_size=batch_size)
+
+    def commit_and_minimize(self, redo=None, retries=3):
+        conflicts = 0
+        while self.conflicts and redo is not None:
+            self.conflicts -= 1
+            conflicts += 1
+            redo()
+        self.commits.append(conflicts)
+        return conflicts
+
+    def log_mem(self, tag=''):
+        return self.used
+
+
+class TestBatchLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def run_loop(self, migrator, items, **kwargs):
+        loop = BatchLoop(migrator, 'test', items, total=len(items), **kwargs)
+        handled = []
+        for item in loop:
+            handled.append(item)
+        return loop, handled
+
+    def test_loop(self):
+        migrator = FakeMigrator()
+        loop, handled = self.run_loop(migrator, list(range(25)), batch_size=10)
+        self.assertEqual(handled, list(range(25)))
+        self.assertTrue(loop.finished)
+        # 2 intermediate commits and the last one
+        self.assertEqual(migrator.commits, [0, 0, 0])
+        self.assertEqual(migrator.loop_stats['test'], {'processed': 25, 'conflicts': 0, 'stopped': False,
+                                                       'finished': True})
+
+    def test_no_commit(self):
+        migrator = FakeMigrator()
+        loop, handled = self.run_loop(migrator, list(range(25)))
+        self.assertEqual(len(handled), 25)
+        self.assertEqual(migrator.commits, [])
+        self.assertTrue(loop.finished)
+
+    def test_redo(self):
+        migrator = FakeMigrator()
+        redone = []
+        before = []
+        loop = BatchLoop(migrator, 'test', list(range(25)), total=25, batch_size=10, redo=redone.append,
+                         before_commit=lambda: before.append(loop.current_key))
+        for item in loop:
+            if item == 12:
+                migrator.conflicts = 1
+        # the chunk of the conflicting commit is done again
+        self.assertEqual(redone, list(range(10, 20)))
+        self.assertEqual(before, [9, 19, 24])
+        self.assertEqual(migrator.commits, [0, 1, 0])
+        self.assertEqual(loop.stats['conflicts'], 1)
+
+    def test_max_mem(self):
+        migrator = FakeMigrator()
+        migrator.used = 1000
+        loop, handled = self.run_loop(migrator, list(range(25)), batch_size=10, max_mem=500)
+        self.assertEqual(handled, list(range(10)))
+        self.assertFalse(loop.finished)
+        self.assertTrue(loop.stats['stopped'])
+        self.assertEqual(migrator.commits, [0])
+        # without intermediate commit, memory would never be checked
+        self.assertRaises(ValueError, BatchLoop, migrator, 'test', list(range(25)), total=25, max_mem=500)
+
+    def test_batching(self):
+        os.environ['BATCH'] = '4'
+        pklfile = os.path.join(self.tmpdir, 'test.pkl')
+        items = ['/plone/obj-{}'.format(nb) for nb in range(10)]
+        loop, handled = self.run_loop(FakeMigrator(), items, pklfile=pklfile)
+        self.assertEqual(handled, items[:4])
+        self.assertFalse(loop.finished)
+        loop, handled = self.run_loop(FakeMigrator(), items, pklfile=pklfile)
+        self.assertEqual(handled, items[4:8])
+        self.assertEqual(loop.progress.skipped, 4)
+        self.assertFalse(loop.finished)
+        os.environ['BATCH_LAST'] = '1'
+        loop, handled = self.run_loop(FakeMigrator(), items, pklfile=pklfile)
+        self.assertEqual(handled, items[8:])
+        self.assertTrue(loop.finished)
+        # batching files are renamed
+        self.assertFalse(os.path.exists(pklfile))
+
+    def test_batching_estimated(self):
+        os.environ['BATCH'] = '4'
+        pklfile = os.path.join(self.tmpdir, 'test.pkl')
+        items = list(range(6))
+        # the estimate is higher than the items count: a complete first run is finished
+        loop = BatchLoop(FakeMigrator(), 'test', items[:3], total=10, pklfile=pklfile, estimated=True)
+        self.assertEqual(list(loop), items[:3])
+        self.assertTrue(loop.finished)
+        self.assertFalse(os.path.exists(pklfile))
+        # the estimate is lower than the items count: a stopped first run is not finished
+        loop = BatchLoop(FakeMigrator(), 'test', items, total=2, pklfile=pklfile, estimated=True)
+        self.assertEqual(list(loop), items[:4])
+        self.assertFalse(loop.finished)
+        self.assertTrue(os.path.exists(pklfile))
+
+    def test_batching_key(self):
+        os.environ['BATCH'] = '3'
+        pklfile = os.path.join(self.tmpdir, 'test.pkl')
+        items = list(range(5))
+        loop, handled = self.run_loop(FakeMigrator(), items, pklfile=pklfile, key=lambda item: 'key-{}'.format(item))
+        self.assertEqual(handled, [0, 1, 2])
+        self.assertEqual(loop.current_key, 'key-2')
+        loop, handled = self.run_loop(FakeMigrator(), items, pklfile=pklfile, key=lambda item: 'key-{}'.format(item))
+        self.assertEqual(handled, [3, 4])
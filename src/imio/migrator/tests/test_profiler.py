@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from imio.migrator.profiler import frame_label
+from imio.migrator.profiler import NO_SECTION
+from imio.migrator.profiler import SamplingProfiler
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+FRAMES = (('main', os.path.join('src', 'run.py'), 1), ('reindex', os.path.join('src', 'imio', 'migrator.py'), 10))
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_frame_label(self):
+        self.assertEqual(frame_label(FRAMES[1]), 'reindex (imio/migrator.py:10)')
+
+    def test_pop(self):
+        profiler = SamplingProfiler()
+        for name in ('part', 'step', 'reindex', 'step', 'inner'):
+            profiler.push(name)
+        # the last occurrence is closed, with its inner sections
+        profiler.pop('step')
+        self.assertEqual(profiler.sections, ['part', 'step', 'reindex'])
+        # an unknown section is ignored
+        profiler.pop('unknown')
+        self.assertEqual(profiler.sections, ['part', 'step', 'reindex'])
+        profiler.pop('part')
+        self.assertEqual(profiler.sections, [])
+
+    def test_write(self):
+        profiler = SamplingProfiler(interval=0.01)
+        profiler.samples[NO_SECTION] = {((), FRAMES[:1]): 1}
+        profiler.samples['step;1'] = {(('part', 'step;1'), FRAMES): 3, (('part', 'step;1'), FRAMES[:1]): 1}
+        hotspots_file, collapsed_file = profiler.write(os.path.join(self.tmpdir, 'profile'))
+        self.assertEqual(hotspots_file, os.path.join(self.tmpdir, 'profile.hotspots.txt'))
+        with open(collapsed_file) as fh:
+            lines = sorted(fh.read().splitlines())
+        self.assertEqual(lines, ['main (src/run.py:1) 1',
+                                 'part;step,1;main (src/run.py:1) 1',
+                                 'part;step,1;main (src/run.py:1);reindex (imio/migrator.py:10) 3'])
+        with open(hotspots_file) as fh:
+            hotspots = fh.read()
+        self.assertIn('step;1: 4 samples, ~0.04 s', hotspots)
+        self.assertIn('   75.0%       3  reindex (imio/migrator.py:10)', hotspots)
+        self.assertIn('  100.0%       4  main (src/run.py:1)', hotspots)
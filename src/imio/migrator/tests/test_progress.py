@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from imio.migrator import progress
+from imio.migrator.progress import get_sinks
+from imio.migrator.progress import JsonLinesSink
+from imio.migrator.progress import LogSink
+from imio.migrator.progress import Progress
+from imio.migrator.progress import StatusFileSink
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ListSink(object):
+
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+
+class TestProgress(unittest.TestCase):
+
+    def setUp(self):
+        self.process_memory = progress.process_memory
+        progress.process_memory = lambda: 100
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        progress.process_memory = self.process_memory
+        shutil.rmtree(self.tmpdir)
+
+    def test_iter(self):
+        sink = ListSink()
+        prog = Progress('loop', range(10), total=10, sinks=[sink], interval=0)
+        for nb in prog:
+            if nb % 3 == 0:
+                prog.skip()
+        prog.finish()
+        self.assertEqual(prog.done, 10)
+        self.assertEqual(prog.skipped, 4)
+        self.assertEqual(prog.processed, 6)
+        kinds = [event['event'] for event in sink.events]
+        self.assertEqual(kinds[0], 'start')
+        self.assertEqual(kinds[-1], 'finish')
+        self.assertEqual(kinds.count('progress'), 10)
+        self.assertEqual(sink.events[-1]['done'], 10)
+        self.assertEqual(sink.events[-1]['percent'], 100.0)
+        self.assertEqual(sink.events[-1]['memory'], 100)
+        # eta is only given on progress events
+        self.assertIsNone(sink.events[-1]['eta'])
+
+    def test_break(self):
+        prog = Progress('loop', range(10), sinks=[], interval=3600)
+        for nb in prog:
+            if nb == 4:
+                break
+        # the item where the loop is left is counted
+        self.assertEqual(prog.done, 5)
+
+    def test_interval(self):
+        sink = ListSink()
+        prog = Progress('loop', range(100), sinks=[sink], interval=3600)
+        for nb in prog:
+            pass
+        self.assertEqual([event['event'] for event in sink.events], ['start'])
+
+    def test_pghandler(self):
+        sink = ListSink()
+        prog = Progress('handler', sinks=[sink], interval=0)
+        prog.init('refreshCatalog', 4)
+        # already started
+        prog.init('other', 8)
+        prog.info('message')
+        prog.report(2)
+        prog.finish()
+        self.assertEqual([event['event'] for event in sink.events], ['start', 'info', 'progress', 'finish'])
+        self.assertEqual(sink.events[1]['msg'], 'message')
+        self.assertEqual(sink.events[2]['name'], 'refreshCatalog')
+        self.assertEqual(sink.events[2]['done'], 2)
+        self.assertEqual(sink.events[2]['total'], 4)
+
+    def test_get_sinks(self):
+        jsonl_path = os.path.join(self.tmpdir, 'progress.jsonl')
+        status_path = os.path.join(self.tmpdir, 'status.json')
+        sinks = get_sinks('log, jsonl:{0},status:{1},unknown,jsonl'.format(jsonl_path, status_path))
+        self.assertEqual([sink.__class__ for sink in sinks], [LogSink, JsonLinesSink, StatusFileSink])
+        prog = Progress('loop', range(3), total=3, sinks=sinks, interval=0)
+        for nb in prog:
+            pass
+        prog.finish()
+        with open(jsonl_path) as fh:
+            events = [json.loads(line) for line in fh]
+        self.assertEqual([event['event'] for event in events], ['start', 'progress', 'progress', 'progress',
+                                                                  'finish'])
+        with open(status_path) as fh:
+            self.assertEqual(json.load(fh)['event'], 'finish')
+        self.assertFalse(os.path.exists(status_path + '.tmp'))
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+from Acquisition import aq_base
+from imio.migrator.migrator import Migrator
+from imio.migrator.migrator import SCHEMA_CHANGE_ATTR
+from imio.migrator.migrator import SCHEMA_CHANGES_REQ_VALUE
+from imio.migrator.testing import MIGRATOR_TESTING_PROFILE_FUNCTIONAL
+from plone import api
+from plone.app.testing import login
+from plone.app.testing import setRoles
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import TEST_USER_NAME
+
+import transaction
+import unittest
+
+
+class InterruptedMigrator(Migrator):
+    """Migrator whose schema change pass fails after p_fail_after converted records."""
+
+    def __init__(self, context, fail_after=0):
+        super(InterruptedMigrator, self).__init__(context)
+        self.fail_after = fail_after
+        self.converted = 0
+
+    def convert_record(self, record, progress, wrapper=None):
+        if self.converted == self.fail_after:
+            raise RuntimeError('interrupted')
+        self.converted += 1
+        return super(InterruptedMigrator, self).convert_record(record, progress, wrapper)
+
+
+class RecatalogingMigrator(Migrator):
+    """Migrator recataloging p_obj with a new title when the schema change pass converts its last record."""
+
+    def __init__(self, context, obj=None):
+        super(RecatalogingMigrator, self).__init__(context)
+        self.obj = obj
+        self.converted = 0
+
+    def convert_record(self, record, progress, wrapper=None):
+        self.converted += 1
+        if self.converted == len(self.catalog._catalog):
+            self.obj.setTitle('Changed title')
+            self.obj.reindexObject()
+        return super(RecatalogingMigrator, self).convert_record(record, progress, wrapper)
+
+
+class TestSchemaChanges(unittest.TestCase):
+    """Catalog schema changes are tested with commits, so on the functional layer."""
+
+    layer = MIGRATOR_TESTING_PROFILE_FUNCTIONAL
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        login(self.portal, TEST_USER_NAME)
+        self.catalog = api.portal.get_tool('portal_catalog')
+        self.docs = [api.content.create(container=self.portal, type='Document', id='doc{}'.format(nb),
+                                        title='Doc {}'.format(nb), description='Description {}'.format(nb))
+                     for nb in range(5)]
+        transaction.commit()
+
+    def tearDown(self):
+        self.portal.REQUEST.set(SCHEMA_CHANGES_REQ_VALUE, None)
+
+    def migrator(self, migrator_class=Migrator, **kwargs):
+        migrator = migrator_class(self.portal, **kwargs)
+        migrator.report_file = ''
+        migrator.collect_schema_changes()
+        return migrator
+
+    def brain(self, doc):
+        return self.catalog.unrestrictedSearchResults(UID=doc.UID())[0]
+
+    def test_remove_column(self):
+        zcatalog = self.catalog._catalog
+        self.assertIn('Description', zcatalog.names)
+        migrator = self.migrator()
+        migrator.removeUnusedColumns(columns=['Description'])
+        # only scheduled
+        self.assertIn('Description', zcatalog.names)
+        self.assertTrue(migrator.apply_schema_changes(batch_size=2))
+        self.assertNotIn('Description', zcatalog.names)
+        self.assertNotIn('Description', zcatalog.schema)
+        self.assertEqual(len(zcatalog.data[self.brain(self.docs[0]).getRID()]), len(zcatalog.names))
+        for doc in self.docs:
+            brain = self.brain(doc)
+            self.assertEqual(brain.Title, doc.Title())
+            self.assertEqual(brain.portal_type, 'Document')
+        self.assertFalse(hasattr(aq_base(zcatalog), SCHEMA_CHANGE_ATTR))
+
+    def test_add_column_and_index(self):
+        zcatalog = self.catalog._catalog
+        self.assertNotIn('title_or_id', zcatalog.names)
+        migrator = self.migrator()
+        migrator.schedule_schema_change(add_indexes={'title_or_id': ('FieldIndex', None)},
+                                        add_columns=['title_or_id'])
+        migrator.apply_schema_changes(batch_size=2)
+        self.assertEqual(zcatalog.names[-1], 'title_or_id')
+        self.assertIn('title_or_id', self.catalog.indexes())
+        for doc in self.docs:
+            self.assertEqual(self.brain(doc).title_or_id, doc.Title())
+            self.assertEqual(self.brain(doc).Description, doc.Description())
+            self.assertEqual(len(self.catalog.unrestrictedSearchResults(title_or_id=doc.Title())), 1)
+
+    def test_resume(self):
+        zcatalog = self.catalog._catalog
+        migrator = self.migrator(InterruptedMigrator, fail_after=3)
+        migrator.removeUnusedColumns(columns=['Description'])
+        self.assertRaises(RuntimeError, migrator.apply_schema_changes, batch_size=2)
+        transaction.abort()
+        progress = getattr(aq_base(zcatalog), SCHEMA_CHANGE_ATTR)
+        # the first chunk is committed, the schema is not yet changed
+        self.assertIsNotNone(progress['last_rid'])
+        self.assertEqual(len(progress['data']), 2)
+        self.assertIn('Description', zcatalog.names)
+        self.assertEqual(self.brain(self.docs[0]).Description, 'Description 0')
+        self.portal.REQUEST.set(SCHEMA_CHANGES_REQ_VALUE, None)
+        # the interrupted pass is continued, then the newly scheduled changes are applied
+        migrator = self.migrator()
+        migrator.schedule_schema_change(add_columns=['title_or_id'])
+        migrator.apply_schema_changes(batch_size=2)
+        self.assertNotIn('Description', zcatalog.names)
+        self.assertEqual(zcatalog.names[-1], 'title_or_id')
+        for doc in self.docs:
+            self.assertEqual(self.brain(doc).Title, doc.Title())
+            self.assertEqual(self.brain(doc).title_or_id, doc.Title())
+        self.assertFalse(hasattr(aq_base(zcatalog), SCHEMA_CHANGE_ATTR))
+
+    def test_resume_unknown_layout(self):
+        zcatalog = self.catalog._catalog
+        migrator = self.migrator(InterruptedMigrator, fail_after=3)
+        migrator.removeUnusedColumns(columns=['Description'])
+        self.assertRaises(RuntimeError, migrator.apply_schema_changes, batch_size=2)
+        transaction.abort()
+        progress = getattr(aq_base(zcatalog), SCHEMA_CHANGE_ATTR)
+        progress['old_names'] = progress['old_names'][1:]
+        setattr(zcatalog, SCHEMA_CHANGE_ATTR, progress)
+        transaction.commit()
+        self.assertRaises(ValueError, self.migrator().apply_schema_changes)
+
+    def test_recataloged_during_pass(self):
+        zcatalog = self.catalog._catalog
+        migrator = self.migrator(RecatalogingMigrator, obj=self.docs[0])
+        migrator.removeUnusedColumns(columns=['Description'])
+        migrator.apply_schema_changes(batch_size=2)
+        self.assertNotIn('Description', zcatalog.names)
+        # the record changed after its conversion is converted again
+        self.assertEqual(self.brain(self.docs[0]).Title, 'Changed title')
+        self.assertEqual(migrator.loop_stats['catch_up_records']['converted'], 1)
+        for doc in self.docs[1:]:
+            self.assertEqual(self.brain(doc).Title, doc.Title())
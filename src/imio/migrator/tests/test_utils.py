@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from BTrees.IIBTree import IITreeSet
+from BTrees.OOBTree import OOBTree
+from imio.migrator.utils import in_shard
+from imio.migrator.utils import iterate_keys
+
+import unittest
+
+
+class TestIterateKeys(unittest.TestCase):
+
+    def test_iterate_keys(self):
+        tree = OOBTree([('/plone/obj-{:03d}'.format(nb), nb) for nb in range(25)])
+        self.assertEqual(list(iterate_keys(tree, chunk_size=10)), list(tree.keys()))
+        self.assertEqual(list(iterate_keys(tree, chunk_size=5)), list(tree.keys()))
+        self.assertEqual(list(iterate_keys(tree, chunk_size=100)), list(tree.keys()))
+        self.assertEqual(list(iterate_keys(tree, chunk_size=10, after='/plone/obj-019')),
+                         ['/plone/obj-{:03d}'.format(nb) for nb in range(20, 25)])
+        self.assertEqual(list(iterate_keys(tree, after='/plone/obj-024')), [])
+        self.assertEqual(list(iterate_keys(OOBTree())), [])
+
+    def test_iterate_keys_changed_tree(self):
+        tree = IITreeSet(range(10))
+        keys = []
+        for key in iterate_keys(tree, chunk_size=3):
+            keys.append(key)
+            if key == 4:
+                # keys added or removed after the current key are seen as the tree is read again by chunk
+                tree.insert(100)
+                tree.remove(8)
+        self.assertEqual(keys, [0, 1, 2, 3, 4, 5, 6, 7, 9, 100])
+
+
+class TestInShard(unittest.TestCase):
+
+    def test_in_shard(self):
+        paths = ['/plone/obj-{}'.format(nb) for nb in range(300)]
+        shards = [[path for path in paths if in_shard(path, (number, 3))] for number in range(3)]
+        # shards are disjoint and cover all the keys
+        self.assertEqual(sorted(sum(shards, [])), sorted(paths))
+        self.assertTrue(all(shards))
+        # the dispatching is stable and doesn't depend on the key type
+        self.assertEqual(in_shard('/plone/obj-1', (0, 3)), in_shard(u'/plone/obj-1', (0, 3)))
+        self.assertEqual(in_shard('/plone/obj-1', (0, 3)), in_shard(b'/plone/obj-1', (0, 3)))
+        self.assertTrue(in_shard(12, (0, 1)))
@@ -4,8 +4,13 @@
 # ------------------------------------------------------------------------------
 
 from plone import api
+from Products.CMFPlone.interfaces import IPloneSiteRoot
 
+import itertools
+import os
+import resource
 import time
+import zlib
 
 
 def end_time(start_time,
@@ -42,6 +47,57 @@ def end_time(start_time,
     return msg
 
 
+def resource_usage(jar=None):
+    """Get a snapshot of the process resources usage: wall and cpu times (in seconds),
+       peak resident memory (in Mb) and, if a ZODB connection p_jar is given, objects loads and stores."""
+    times = os.times()
+    usage = {'wall': time.time(),
+             'cpu': times[0] + times[1],
+             # ru_maxrss is in Kb on Linux
+             'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+             'loads': 0,
+             'stores': 0}
+    if jar is not None:
+        usage['loads'], usage['stores'] = jar.getTransferCounts()
+    return usage
+
+
+def iterate_keys(tree, chunk_size=1000, after=None):
+    """Lazily yield the keys of a BTree or TreeSet p_tree, starting after
+       the p_after key if given.
+       Keys are fetched p_chunk_size by p_chunk_size, restarting each time
+       from the last got key: the tree can so be safely walked across
+       transaction commits and cache minimizations."""
+    keys = tree.keys() if after is None else tree.keys(min=after, excludemin=True)
+    while True:
+        chunk = list(itertools.islice(keys, chunk_size))
+        for key in chunk:
+            yield key
+        if len(chunk) < chunk_size:
+            break
+        keys = tree.keys(min=chunk[-1], excludemin=True)
+
+
+def in_shard(key, shard):
+    """Check if p_key belongs to p_shard, a (shard number, shards count) tuple.
+       The key is dispatched with a stable hash, so shards are disjoint across processes."""
+    number, count = shard
+    if not isinstance(key, bytes):
+        key = u'{}'.format(key).encode('utf8')
+    return (zlib.crc32(key) & 0xffffffff) % count == number
+
+
+def get_plone_sites(root):
+    """Get the Plone sites found in p_root (the Zope application), also in its sub-folders."""
+    sites = []
+    for obj in root.objectValues():
+        if IPloneSiteRoot.providedBy(obj):
+            sites.append(obj)
+        elif getattr(obj, 'meta_type', None) == 'Folder':
+            sites.extend(get_plone_sites(obj))
+    return sites
+
+
 def ensure_upgraded(package_name):
     """Make sure the given p_package_name is upgraded, this is useful when some
        code will rely on fact that a record is in the registry or so.
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------------------
+# GNU General Public License (GPL)
+# ------------------------------------------------------------------------------
+"""
+Run Migrator methods in parallel Zope clients.
+
+The driver writes a json task file per worker and starts `bin/instance run workers.py task_file`.
+Each worker runs the task Migrator method on the task site and writes a json report.
+Workers must share the same storage (ZEO or RelStorage).
+"""
+
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+logger = logging.getLogger('imio.migrator')
+
+
+def run_workers(site, tasks, instance=None):
+    """Run each task of p_tasks in a separated Zope client and wait for all of them.
+
+    :param site: the site object (or its path) on which the tasks are run
+    :param tasks: list of dicts with keys 'method' (Migrator method name), 'kwargs' (method parameters),
+                  optionally 'migrator' (dotted name of the Migrator class), 'site' (site path),
+                  'sites' (sites paths on which the migrator is run) and 'env' (additional environment variables)
+    :param instance: instance script (default is MIGRATOR_INSTANCE env or bin/instance)
+    :return: the list of workers reports
+    """
+    if instance is None:
+        instance = os.getenv('MIGRATOR_INSTANCE', os.path.join('bin', 'instance'))
+    if not isinstance(site, str):
+        site = '/'.join(site.getPhysicalPath())
+    # this module is also the worker script
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    workdir = tempfile.mkdtemp(prefix='imio.migrator.')
+    processes = []
+    for nb, task in enumerate(tasks):
+        task = dict(task)
+        task.setdefault('site', site)
+        task['id'] = nb
+        task['report'] = os.path.join(workdir, 'report_{}.json'.format(nb))
+        task_file = os.path.join(workdir, 'task_{}.json'.format(nb))
+        with open(task_file, 'w') as fh:
+            json.dump(task, fh)
+        env = dict(os.environ)
+        env.update(task.get('env', {}))
+        logger.info('Starting worker {0}: {1} on {2}'.format(nb, task.get('method', 'run'),
+                                                             ', '.join(task.get('sites') or [task['site']])))
+        processes.append((task, subprocess.Popen([instance, 'run', script, task_file], env=env)))
+    reports = []
+    for task, process in processes:
+        returncode = process.wait()
+        report = {'id': task['id'], 'site': task['site'], 'error': 'No report written'}
+        if os.path.exists(task['report']):
+            with open(task['report']) as fh:
+                report = json.load(fh)
+        if returncode and not report.get('error'):
+            report['error'] = 'Exit code {}'.format(returncode)
+        reports.append(report)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return reports
+
+
+def merge_reports(reports):
+    """Merge workers p_reports into one summary dict."""
+    summary = {'workers': len(reports), 'processed': 0, 'conflicts': 0, 'seconds': 0, 'failed': [],
+               'warnings': [], 'finished': True}
+    for report in reports:
+        summary['seconds'] = max(summary['seconds'], report.get('seconds', 0))
+        summary['warnings'].extend(report.get('warnings', []))
+        for stats in report.get('loop_stats', {}).values():
+            summary['processed'] += stats.get('processed', 0)
+            summary['conflicts'] += stats.get('conflicts', 0)
+        if report.get('error'):
+            summary['failed'].append(report)
+            summary['finished'] = False
+        elif report.get('result') is False:
+            summary['finished'] = False
+    return summary
+
+
+def setup_app(app):
+    """Prepare the Zope p_app got in a script run with 'instance run': add a request and log in as system user.
+       Returns the request wrapped app."""
+    from AccessControl.SecurityManagement import newSecurityManager
+    from AccessControl.SpecialUsers import system
+    from Testing.makerequest import makerequest
+
+    app = makerequest(app)
+    newSecurityManager(None, system)
+    return app
+
+
+def run_task(app, task_file):
+    """Run the task described in p_task_file. Called in the worker Zope client.
+       If the task has a 'sites' key, the migrator is run on each of these sites (see runner.run_on_sites)."""
+    from zope.component.hooks import setSite
+    from zope.dottedname.resolve import resolve
+
+    import transaction
+
+    with open(task_file) as fh:
+        task = json.load(fh)
+    report = {'id': task['id'], 'site': task['site'], 'error': None}
+    start = time.time()
+    try:
+        app = setup_app(app)
+        migrator_class = resolve(task.get('migrator', 'imio.migrator.migrator.Migrator'))
+        if task.get('sites'):
+            from imio.migrator.runner import run_on_sites
+            report.update(run_on_sites(app, migrator_class, sites=task['sites'], report_file=''))
+            report['error'] = report['failed'] and 'Failed sites: {}'.format(', '.join(report['failed'])) or None
+        else:
+            site = app.unrestrictedTraverse(str(task['site']))
+            setSite(site)
+            migrator = migrator_class(site)
+            kwargs = dict([(str(key), value) for key, value in task.get('kwargs', {}).items()])
+            report['result'] = getattr(migrator, task['method'])(**kwargs)
+            transaction.commit()
+            report['loop_stats'] = migrator.loop_stats
+            report['warnings'] = migrator.warnings
+    except Exception as exc:
+        transaction.abort()
+        logger.exception('Worker {0} failed'.format(task['id']))
+        report['error'] = repr(exc)
+    report['seconds'] = int(time.time() - start)
+    with open(task['report'], 'w') as fh:
+        json.dump(report, fh, default=repr)
+    return report
+
+
+if __name__ == '__main__':
+    # 'app' is defined by 'instance run'
+    run_task(app, sys.argv[-1])  # noqa: F821